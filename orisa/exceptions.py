@@ -25,6 +25,10 @@ class UnableToFindSR(RuntimeError):
     pass
 
 
+class ProfileUnchanged(RuntimeError):
+    "The career profile has not changed since the last sync"
+
+
 class NicknameTooLong(RuntimeError):
     def __init__(self, nickname):
         self.nickname = nickname
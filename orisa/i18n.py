@@ -155,16 +155,20 @@ class I18NCommandsManager(CommandsManager):
             locale = orisa._welcome_language.get(guild_id, None)
 
         # update locale for user, or get locale from user if we have no locale
-        async with orisa.database.session() as session:
-            user = await orisa.database.user_by_discord_id(session, message.author_id)
-            if user:
-                if locale:
-                    if user.locale != locale:
-                        user.locale = locale
-                        await run_sync(session.commit)
-                elif guild_id is None:
-                    # only change language in private messages
-                    locale = user.locale
+        snapshot = await orisa.database.user_snapshot(message.author_id)
+        if snapshot:
+            if locale:
+                if snapshot.locale != locale:
+                    async with orisa.database.session() as session:
+                        user = await orisa.database.user_by_discord_id(
+                            session, message.author_id
+                        )
+                        if user:
+                            user.locale = locale
+                            await run_sync(session.commit)
+            elif guild_id is None:
+                # only change language in private messages
+                locale = snapshot.locale
 
         CurrentLocale.set(locale or DEFAULT_LOCALE)
 
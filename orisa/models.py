@@ -12,14 +12,17 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
-import random
+import logging
+import threading
 import typing
 
-from contextlib import asynccontextmanager
+from collections import defaultdict
+from contextlib import asynccontextmanager, suppress
 from datetime import datetime, timedelta
 from enum import Flag, auto
 
 import trio
+from cachetools import LRUCache
 
 from sqlalchemy import (
     BigInteger,
@@ -27,23 +30,28 @@ from sqlalchemy import (
     Column,
     DateTime,
     ForeignKey,
+    Index,
     Integer,
     SmallInteger,
     String,
+    and_,
     create_engine,
+    event,
     func,
+    or_,
 )
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.ext.orderinglist import ordering_list
-from sqlalchemy.sql.functions import coalesce
-from sqlalchemy.orm import raiseload, relationship, sessionmaker
+from sqlalchemy.orm import joinedload, raiseload, relationship, sessionmaker
 import sqlalchemy.types as types
 
-from .config import DATABASE_URI
-from .utils import sr_to_rank, TDS, run_sync
+from .config import DATABASE_URI, DEVELOPMENT
+from .utils import DB_MAX_OVERFLOW, DB_POOL_SIZE, sr_to_rank, TDS, run_sync
 from .i18n import _, N_, NP_
 
+logger = logging.getLogger(__name__)
+
 Base = declarative_base()
 
 
@@ -86,6 +94,26 @@ class RoleType(types.TypeDecorator):
             )
 
 
+def sync_delay(error_count, jitter=0):
+    "How long to wait before syncing a handle again"
+    if error_count == 0:
+        # slight randomization (jitter is 0 to 2) to avoid having all
+        # battletags update at the same time if Orisa didn't run
+        # for a while
+        return timedelta(minutes=720 + jitter)
+    elif 0 < error_count < 3:
+        return timedelta(
+            minutes=5
+        )  # we actually want to try again fast, in case it was a temporary problem
+    elif 3 <= error_count < 5:
+        return timedelta(minutes=840)  # ok, the error's not going away, so wait longer
+    elif 5 <= error_count < 10:
+        # exponential backoff
+        return timedelta(minutes=840 + 20 * (error_count - 5) ** 2)
+    else:
+        return timedelta(days=1)
+
+
 class HighscoreCron(Base):
     __tablename__ = "highscore_cron"
 
@@ -149,10 +177,16 @@ class Handle(Base):
         lazy="joined",
     )
     web_profile_uuid = Column(String, nullable=True)
-
+    # validators of the career profile page and a hash of its rank summary,
+    # used to detect unchanged profiles during sync
+    profile_etag = Column(String, nullable=True)
+    profile_last_modified = Column(String, nullable=True)
+    profile_hash = Column(String(40), nullable=True)
 
     error_count = Column(Integer, nullable=False, default=0)
 
+    next_sync_at = Column(DateTime, nullable=True, index=True)
+
     __mapper_args__ = {"polymorphic_on": type}
 
     @property
@@ -174,11 +208,13 @@ class Handle(Base):
         if new_srs is None:
             new_srs = TDS(None, None, None)
 
-        if (
-            len(self.sr_history[:2]) > 1
-            and self.sr_history[0].values == self.sr_history[1].values
-        ):
-            sr_obj = self.sr_history[0]
+        # sr_history is a dynamic relationship, every index access is a query.
+        # Slicing (unlike .limit()) also works for a handle that hasn't been
+        # flushed yet, it then returns the SRs added in memory
+        last_two = self.sr_history[:2]
+
+        if len(last_two) > 1 and last_two[0].values == last_two[1].values:
+            sr_obj = last_two[0]
             sr_obj.timestamp = timestamp
             sr_obj.values = new_srs
         else:
@@ -194,6 +230,9 @@ class Handle(Base):
             )  # sqlalchemy dynamic wrapper does not support prepend
 
         self.current_sr = sr_obj
+        self.next_sync_at = timestamp + sync_delay(
+            self.error_count or 0, jitter=(self.id or 0) % 3
+        )
 
     def __repr__(self):
         return f"<Handle(id={self.id})>"
@@ -303,6 +342,10 @@ class OnlineID(Handle):
 
 class SR(Base):
     __tablename__ = "srs"
+    __table_args__ = (
+        # history and point in time lookups of a handle
+        Index("ix_srs_handle_id_timestamp", "handle_id", "timestamp"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     handle_id = Column(Integer, ForeignKey("handle.id"), nullable=False, index=True)
@@ -338,6 +381,18 @@ class SR(Base):
         return f"<SR(id={self.id}, values={self.values})>"
 
 
+class WebProfileResolution(Base):
+    "Result of searching the web profile UUID of a BattleTag; a NULL UUID means no account was found"
+    __tablename__ = "web_profile_resolutions"
+
+    battle_tag = Column(String, primary_key=True)
+    web_profile_uuid = Column(String, nullable=True)
+    resolved_at = Column(DateTime, nullable=False)
+
+    def __repr__(self):
+        return f"<WebProfileResolution(battle_tag={self.battle_tag}, web_profile_uuid={self.web_profile_uuid})>"
+
+
 class GuildConfigJson(Base):
     __tablename__ = "guild_configs"
 
@@ -355,16 +410,254 @@ class WelcomeMessage(Base):
     guild_name = Column(String)
 
 
+class UserSnapshot(typing.NamedTuple):
+    "Read-only copy of the user data needed by the frequent event handlers"
+    id: int
+    discord_id: int
+    handle_ids: typing.Tuple[int, ...]
+    locale: str
+    format: str
+    always_show_sr: bool
+    has_secondaries: bool
+    # SR of the primary handle and SRs to show in the nick (see Database.nick_sr)
+    primary_sr: TDS
+    nick_sr: TDS
+
+
+class _EvictingLRUCache(LRUCache):
+    "LRUCache that reports the values it drops to make room"
+
+    def __init__(self, maxsize, on_evict):
+        super().__init__(maxsize=maxsize)
+        self._on_evict = on_evict
+
+    def popitem(self):
+        key, value = super().popitem()
+        self._on_evict(value)
+        return key, value
+
+
+class UserSnapshotCache:
+    """LRU cache of UserSnapshots by discord id, including unregistered users (None).
+
+    Entries are invalidated whenever a flush or commit touches the user, one of
+    its handles or their SRs. Flushes happen in DB threads, hence the lock. The
+    reverse mappings used for that only contain users that are in the cache."""
+
+    def __init__(self, maxsize=10000):
+        self._lock = threading.Lock()
+        self._snapshots = _EvictingLRUCache(maxsize, self._forget)
+        self._discord_id_by_user_id = {}
+        self._user_id_by_handle_id = {}
+        # incremented on every invalidation, so that a snapshot loaded while the
+        # user was being changed doesn't end up in the cache
+        self.generation = 0
+
+    def __getitem__(self, discord_id):
+        with self._lock:
+            return self._snapshots[discord_id]
+
+    def store(self, discord_id, snapshot, generation):
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._forget(self._snapshots.get(discord_id))
+            self._snapshots[discord_id] = snapshot
+            if snapshot:
+                self._discord_id_by_user_id[snapshot.id] = discord_id
+                for handle_id in snapshot.handle_ids:
+                    self._user_id_by_handle_id[handle_id] = snapshot.id
+
+    def _forget(self, snapshot):
+        "Removes the reverse mappings of a snapshot that leaves the cache"
+        if not snapshot:
+            return
+        if self._discord_id_by_user_id.get(snapshot.id) == snapshot.discord_id:
+            del self._discord_id_by_user_id[snapshot.id]
+        for handle_id in snapshot.handle_ids:
+            if self._user_id_by_handle_id.get(handle_id) == snapshot.id:
+                del self._user_id_by_handle_id[handle_id]
+
+    def invalidate(self, *, discord_ids=(), user_ids=(), handle_ids=()):
+        with self._lock:
+            self.generation += 1
+            user_ids = set(user_ids)
+            for handle_id in handle_ids:
+                with suppress(KeyError):
+                    user_ids.add(self._user_id_by_handle_id[handle_id])
+            discord_ids = set(discord_ids)
+            for user_id in user_ids:
+                with suppress(KeyError):
+                    discord_ids.add(self._discord_id_by_user_id[user_id])
+            for discord_id in discord_ids:
+                self._forget(self._snapshots.pop(discord_id, None))
+
+    def invalidate_for(self, objs):
+        "Invalidates everything the given (changed) ORM objects affect"
+        discord_ids, user_ids, handle_ids = set(), set(), set()
+        for obj in objs:
+            if isinstance(obj, User):
+                discord_ids.add(obj.discord_id)
+                user_ids.add(obj.id)
+            elif isinstance(obj, Handle):
+                user_ids.add(obj.user_id)
+                handle_ids.add(obj.id)
+            elif isinstance(obj, SR):
+                handle_ids.add(obj.handle_id)
+        if discord_ids or user_ids or handle_ids:
+            self.invalidate(
+                discord_ids=discord_ids, user_ids=user_ids, handle_ids=handle_ids
+            )
+
+
+class LeaderboardEntry(typing.NamedTuple):
+    handle_id: int
+    user_id: int
+    discord_id: int
+    sr: TDS
+
+
+class Leaderboards:
+    """Primary BattleTags with a current SR, ranked per role.
+
+    Loaded completely once; afterwards, only handles and users touched by a flush
+    are marked and reloaded (in one query) the next time the leaderboards are
+    needed. Marking happens in DB threads, hence the lock."""
+
+    ROLES = ("tank", "damage", "support")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = None
+        self._changed_handle_ids = set()
+        self._changed_user_ids = set()
+        self._ranked = None
+
+    def mark_changed(self, objs):
+        with self._lock:
+            for obj in objs:
+                if isinstance(obj, User):
+                    self._changed_user_ids.add(obj.id)
+                elif isinstance(obj, Handle):
+                    self._changed_handle_ids.add(obj.id)
+                    self._changed_user_ids.add(obj.user_id)
+                elif isinstance(obj, SR):
+                    self._changed_handle_ids.add(obj.handle_id)
+
+    @staticmethod
+    def _query(session):
+        return (
+            session.query(
+                BattleTag.id,
+                BattleTag.user_id,
+                User.discord_id,
+                SR.tank,
+                SR.damage,
+                SR.support,
+            )
+            .select_from(BattleTag)
+            .join(BattleTag.current_sr)
+            .join(BattleTag.user)
+            .filter(BattleTag.position == 0)
+            .filter(SR.timestamp >= datetime(2023, 1, 1))
+        )
+
+    def refresh(self, session):
+        "Brings the leaderboards up to date, needs to run in a DB thread"
+        with self._lock:
+            handle_ids, user_ids = self._changed_handle_ids, self._changed_user_ids
+            self._changed_handle_ids, self._changed_user_ids = set(), set()
+
+        if self._entries is None:
+            rows = self._query(session).all()
+            self._entries = {}
+        elif handle_ids or user_ids:
+            for handle_id, entry in list(self._entries.items()):
+                if handle_id in handle_ids or entry.user_id in user_ids:
+                    del self._entries[handle_id]
+            rows = (
+                self._query(session)
+                .filter(
+                    or_(
+                        BattleTag.id.in_(handle_ids), BattleTag.user_id.in_(user_ids)
+                    )
+                )
+                .all()
+            )
+        else:
+            return
+
+        for handle_id, user_id, discord_id, *srs in rows:
+            self._entries[handle_id] = LeaderboardEntry(
+                handle_id, user_id, discord_id, TDS(*srs)
+            )
+        self._ranked = None
+
+    def ranked(self):
+        "role -> entries with an SR for that role, highest first"
+        if self._ranked is None:
+            self._ranked = {
+                role: sorted(
+                    (
+                        entry
+                        for entry in self._entries.values()
+                        if getattr(entry.sr, role) is not None
+                    ),
+                    key=lambda entry: getattr(entry.sr, role),
+                    reverse=True,
+                )
+                for role in self.ROLES
+            }
+        return self._ranked
+
+
+def _warn_if_on_event_loop(conn, cursor, statement, parameters, context, executemany):
+    "Debug helper: complains about queries that are not executed via run_sync"
+    try:
+        trio.current_time()
+    except RuntimeError:
+        # not running in the trio thread, all is well
+        return
+    logger.warning(
+        "synchronous DB access on the event loop: %s", statement, stack_info=True
+    )
+
+
 class Database:
     def __init__(self):
         if DATABASE_URI.startswith("sqlite://"):
             engine = create_engine(DATABASE_URI)
         else:
-            engine = create_engine(DATABASE_URI, pool_size=20, max_overflow=10)
+            engine = create_engine(
+                DATABASE_URI, pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW
+            )
+            if DEVELOPMENT:
+                # with SQLite, run_sync doesn't use threads, so everything would trigger
+                event.listen(engine, "before_cursor_execute", _warn_if_on_event_loop)
         self.Session = sessionmaker(bind=engine, autoflush=False)
         Base.metadata.create_all(engine)
 
-        self._min_delay = min(self._sync_delay(x) for x in range(10))
+        self.user_snapshots = UserSnapshotCache()
+        self._leaderboards = Leaderboards()
+        self._leaderboards_lock = trio.Lock()
+        # SRs as of a day before, (day they were computed for, handle id -> TDS)
+        self._previous_srs = (None, {})
+        event.listen(self.Session, "after_flush", self._track_changes)
+        event.listen(self.Session, "after_commit", self._track_changes)
+
+    def _track_changes(self, session, flush_context=None):
+        if flush_context is not None:
+            # after_flush: remember what changed, in case something read the old
+            # values before the commit
+            changed = session.info.setdefault("changed_objs", [])
+            changed.extend(session.new)
+            changed.extend(session.dirty)
+            changed.extend(session.deleted)
+            objs = changed
+        else:
+            objs = session.info.pop("changed_objs", [])
+        self.user_snapshots.invalidate_for(objs)
+        self._leaderboards.mark_changed(objs)
 
     @asynccontextmanager
     async def session(self):
@@ -380,56 +673,333 @@ class Database:
     async def handle_by_id(self, session, id):
         return await run_sync(session.query(Handle).filter_by(id=id).one_or_none)
 
+    async def handles_by_ids(self, session, ids):
+        return await run_sync(
+            session.query(Handle)
+            .options(joinedload(Handle.user))
+            .filter(Handle.id.in_(ids))
+            .all
+        )
+
+    async def previous_highest_srs(self, session, handle):
+        "Highest tank, damage and support SR of all handles of the same type of the handle's user, excluding its current SR"
+
+        def query():
+            # current_sr_id needs to be known for the exclusion to work
+            session.flush()
+            return (
+                session.query(
+                    func.max(SR.tank), func.max(SR.damage), func.max(SR.support)
+                )
+                .join(SR.handle)
+                .filter(
+                    SR.id != handle.current_sr_id,
+                    Handle.user_id == handle.user_id,
+                    Handle.type == handle.type,
+                )
+                .one()
+            )
+
+        return TDS(*await run_sync(query))
+
     async def user_by_discord_id(self, session, discord_id):
         return await run_sync(
             session.query(User).filter_by(discord_id=discord_id).one_or_none
         )
 
-    async def get_srs(self, session, discord_ids):
+    @staticmethod
+    def _incomplete_nick_sr(user):
+        "The current SRs of the user's primary handle if some are missing, else None"
+        all_sr = user.handles[0].sr or TDS(None, None, None)
+        return all_sr if any(x is None for x in all_sr) else None
+
+    @staticmethod
+    def _complete_nick_sr(all_sr, history):
+        # normally, we only save different values for SR, so if there is
+        # a non null value, it should be the second or third, but just
+        # to be sure, check the first 10...
+        # negative value means it's an old one
+        for old_sr in history:
+            if old_sr.timestamp < datetime(2023, 1, 1):
+                break
+            if old_sr.values:
+                all_sr = TDS(
+                    *[av or (ov and -ov) for av, ov in zip(all_sr, old_sr.values)]
+                )
+            if all(x is not None for x in all_sr):
+                break
+        return all_sr
+
+    async def nick_sr(self, session, user):
+        "SRs to show in the nick, older values (from the history) are negative"
+        all_sr = self._incomplete_nick_sr(user)
+        if all_sr is None:
+            return user.handles[0].sr
+
+        history = await self.sr_history(session, user.handles[0], limit=10)
+        return self._complete_nick_sr(all_sr, history)
+
+    async def nick_srs(self, session, users):
+        "nick_sr for many users, fetching the needed history in one query"
+        incomplete = {}
+        result = {}
+        for user in users:
+            all_sr = self._incomplete_nick_sr(user)
+            if all_sr is None:
+                result[user.id] = user.handles[0].sr
+            else:
+                incomplete[user.handles[0].id] = (user, all_sr)
+
+        if incomplete:
+            ranked = (
+                session.query(
+                    SR.id,
+                    func.row_number()
+                    .over(partition_by=SR.handle_id, order_by=SR.timestamp.desc())
+                    .label("row_number"),
+                )
+                .filter(SR.handle_id.in_(incomplete.keys()))
+                .subquery()
+            )
+            history = defaultdict(list)
+            for sr in await run_sync(
+                session.query(SR)
+                .join(ranked, ranked.c.id == SR.id)
+                .filter(ranked.c.row_number <= 10)
+                .order_by(SR.handle_id, SR.timestamp.desc())
+                .all
+            ):
+                history[sr.handle_id].append(sr)
+
+            for handle_id, (user, all_sr) in incomplete.items():
+                result[user.id] = self._complete_nick_sr(all_sr, history[handle_id])
+
+        return result
+
+    async def users_by_discord_ids(self, session, discord_ids, chunk_size=1000):
+        discord_ids = list(discord_ids)
+        users = []
+        for start in range(0, len(discord_ids), chunk_size):
+            users.extend(
+                await run_sync(
+                    session.query(User)
+                    .filter(User.discord_id.in_(discord_ids[start : start + chunk_size]))
+                    .all
+                )
+            )
+        return users
+
+    async def user_snapshot(self, discord_id):
+        """Cached UserSnapshot of the user, or None if not registered.
+
+        handle_ids is empty for a user that is in the middle of registering."""
+        try:
+            return self.user_snapshots[discord_id]
+        except KeyError:
+            pass
+
+        generation = self.user_snapshots.generation
+        async with self.session() as session:
+            user = await self.user_by_discord_id(session, discord_id)
+            if user:
+                if user.handles:
+                    primary_sr = user.handles[0].sr
+                    nick_sr = await self.nick_sr(session, user)
+                else:
+                    # in the middle of registering
+                    primary_sr = nick_sr = None
+                snapshot = UserSnapshot(
+                    id=user.id,
+                    discord_id=user.discord_id,
+                    handle_ids=tuple(handle.id for handle in user.handles),
+                    locale=user.locale,
+                    format=user.format,
+                    always_show_sr=user.always_show_sr,
+                    has_secondaries=len(user.handles) > 1,
+                    primary_sr=primary_sr,
+                    nick_sr=nick_sr,
+                )
+            else:
+                snapshot = None
+        self.user_snapshots.store(discord_id, snapshot, generation)
+        return snapshot
+
+    async def get_primary_srs(self, session, discord_ids):
+        "Current SRs of the primary handles of the given users, by discord id"
+        srs = {}
+        missing = []
+        for discord_id in discord_ids:
+            try:
+                snapshot = self.user_snapshots[discord_id]
+            except KeyError:
+                missing.append(discord_id)
+            else:
+                if snapshot and snapshot.primary_sr:
+                    srs[discord_id] = snapshot.primary_sr
+
+        if missing:
+            # plain columns, no need to build (and track) ORM objects
+            rows = await run_sync(
+                session.query(User.discord_id, SR.tank, SR.damage, SR.support)
+                .select_from(Handle)
+                .join(Handle.current_sr)
+                .join(Handle.user)
+                .filter(Handle.position == 0)
+                .filter(User.discord_id.in_(missing))
+                .all
+            )
+            for discord_id, *values in rows:
+                srs[discord_id] = TDS(*values)
+
+        return srs
+
+    async def get_sync_schedule(self, session):
+        "Returns (handle id, next sync time) for all handles"
+        rows = await run_sync(
+            session.query(
+                Handle.id, Handle.next_sync_at, Handle.error_count, SR.timestamp
+            )
+            .outerjoin(Handle.current_sr)
+            .all
+        )
+        return [
+            (
+                id,
+                # handles that haven't been synced since next_sync_at was introduced
+                next_sync_at
+                or (last_update or datetime.min)
+                + sync_delay(error_count, jitter=id % 3),
+            )
+            for id, next_sync_at, error_count, last_update in rows
+        ]
+
+    async def get_web_profile_resolutions(self, session):
+        return await run_sync(
+            session.query(
+                WebProfileResolution.battle_tag,
+                WebProfileResolution.web_profile_uuid,
+                WebProfileResolution.resolved_at,
+            ).all
+        )
+
+    async def save_web_profile_resolutions(self, session, resolutions, chunk_size=1000):
+        def save():
+            battle_tags = list(resolutions)
+            existing = {}
+            for start in range(0, len(battle_tags), chunk_size):
+                existing.update(
+                    (resolution.battle_tag, resolution)
+                    for resolution in session.query(WebProfileResolution).filter(
+                        WebProfileResolution.battle_tag.in_(
+                            battle_tags[start : start + chunk_size]
+                        )
+                    )
+                )
+
+            for battle_tag, (uuid, resolved_at) in resolutions.items():
+                resolution = existing.get(battle_tag)
+                if resolution is None:
+                    session.add(
+                        WebProfileResolution(
+                            battle_tag=battle_tag,
+                            web_profile_uuid=uuid,
+                            resolved_at=resolved_at,
+                        )
+                    )
+                else:
+                    resolution.web_profile_uuid = uuid
+                    resolution.resolved_at = resolved_at
+            session.commit()
+
+        await run_sync(save)
+
+    async def guild_config_by_id(self, session, id):
         return await run_sync(
-            session.query(SR)
-            .join(Handle.current_sr, User)
-            .filter(Handle.position == 0)
-            .filter(User.discord_id.in_(discord_ids))
+            session.query(GuildConfigJson).filter_by(id=id).one_or_none
+        )
+
+    async def highscore_cron_by_id(self, session, id):
+        return await run_sync(session.query(HighscoreCron).filter_by(id=id).one_or_none)
+
+    async def due_highscore_crons(self, session, now, limit=10):
+        return await run_sync(
+            session.query(HighscoreCron)
+            .filter(HighscoreCron.next_run <= now)
+            .limit(limit)
             .all
         )
 
-    def _sync_delay(self, error_count):
-        if error_count == 0:
-            # slight randomization to avoid having all
-            # battletags update at the same time if Orisa didn't run
-            # for a while
-            return timedelta(minutes=random.randint(720, 722))
-        elif 0 < error_count < 3:
-            return timedelta(
-                minutes=5
-            )  # we actually want to try again fast, in case it was a temporary problem
-        elif 3 <= error_count < 5:
-            return timedelta(
-                minutes=840
-            )  # ok, the error's not going away, so wait longer
-        elif 5 <= error_count < 10:
-            # exponential backoff
-            return timedelta(minutes=840 + 20 * (error_count - 5) ** 2)
-        else:
-            return timedelta(days=1)
+    async def unprocessed_srs(self, session):
+        "SRs that haven't been checked for congratulations yet, newest first"
+        return await run_sync(
+            session.query(SR)
+            .options(joinedload(SR.handle).joinedload(Handle.user))
+            .filter(SR.processed == False)
+            .order_by(SR.timestamp.desc())
+            .all
+        )
 
-    async def get_handles_to_be_synced(self, session):
-        results = await run_sync(
-            session.query(Handle)
-            .outerjoin(Handle.current_sr)
-            .filter(
-                coalesce(SR.timestamp, datetime.min)
-                <= datetime.utcnow() - self._min_delay
+    async def sr_history(self, session, handle, limit=None):
+        "SR history of the handle, newest first"
+        query = (
+            session.query(SR)
+            .filter(SR.handle_id == handle.id)
+            .order_by(SR.timestamp.desc())
+        )
+        if limit is not None:
+            query = query.limit(limit)
+        return await run_sync(query.all)
+
+    async def sr_history_columns(self, session, handle, since=None):
+        """SR history of the handle from since on, oldest first, as the columns
+        (timestamps, tank, damage, support)"""
+        query = session.query(SR.timestamp, SR.tank, SR.damage, SR.support).filter(
+            SR.handle_id == handle.id
+        )
+        if since is not None:
+            query = query.filter(SR.timestamp >= since)
+        rows = await run_sync(query.order_by(SR.timestamp).all)
+        return tuple(zip(*rows)) if rows else ((), (), (), ())
+
+    async def leaderboards(self, session):
+        """Returns the ranked leaderboards (see Leaderboards.ranked) and the SRs of
+        their handles a day before (handle id -> TDS), computed once per day"""
+        async with self._leaderboards_lock:
+            await run_sync(self._leaderboards.refresh, session)
+            ranked = self._leaderboards.ranked()
+
+            today = datetime.utcnow().date()
+            day, previous = self._previous_srs
+            if day != today:
+                previous = await self.srs_as_of(
+                    session, datetime.utcnow() - timedelta(days=1)
+                )
+                self._previous_srs = (today, previous)
+
+        return ranked, previous
+
+    async def srs_as_of(self, session, when, handle_ids=None):
+        """SRs the handles had at the given time (handle id -> TDS), all handles if
+        handle_ids is None. Handles without an SR before that time are missing."""
+        latest = session.query(
+            SR.handle_id, func.max(SR.timestamp).label("timestamp")
+        ).filter(SR.timestamp < when)
+        if handle_ids is not None:
+            latest = latest.filter(SR.handle_id.in_(handle_ids))
+        latest = latest.group_by(SR.handle_id).subquery()
+
+        rows = await run_sync(
+            session.query(SR.handle_id, SR.tank, SR.damage, SR.support)
+            .join(
+                latest,
+                and_(
+                    SR.handle_id == latest.c.handle_id,
+                    SR.timestamp == latest.c.timestamp,
+                ),
             )
             .all
         )
-        return [
-            result.id
-            for result in results
-            if (result.last_update or datetime.min)
-            <= datetime.utcnow() - self._sync_delay(result.error_count)
-        ]
+        return {handle_id: TDS(*values) for handle_id, *values in rows}
 
     async def get_welcome_message(self, session, message_id):
         msg = await run_sync(
@@ -15,10 +15,8 @@
 from collections import defaultdict
 from contextlib import contextmanager, nullcontext, suppress
 from contextvars import ContextVar
-import csv
-from dataclasses import dataclass
 from datetime import datetime, timedelta
-from io import BytesIO, StringIO
+import hashlib
 from itertools import groupby
 import logging
 import logging.config
@@ -27,9 +25,7 @@ import random
 import re
 from string import Template
 import tempfile
-import time
 import urllib.parse
-import warnings
 
 import arrow
 import cachetools
@@ -53,17 +49,12 @@ from fuzzywuzzy import fuzz, process
 import hypercorn.config
 import hypercorn.trio
 from itsdangerous.url_safe import URLSafeTimedSerializer
-import matplotlib
-import matplotlib.pyplot as plt
 import multio
 import numpy as np
 from oauthlib.oauth2 import WebApplicationClient
 import pandas as pd
-from pandas.plotting import register_matplotlib_converters
 import raven
-import seaborn as sns
-from sqlalchemy.orm import joinedload
-from sqlalchemy.sql import desc, func
+from sqlalchemy.orm import object_session
 import tabulate
 import trio
 from trio.to_thread import run_sync
@@ -90,6 +81,7 @@ from .exceptions import (
     InvalidBattleTag,
     InvalidFormat,
     NicknameTooLong,
+    ProfileUnchanged,
     UnableToFindSR,
 )
 from .i18n import CurrentLocale, N_, _, locale_by_flag, ngettext
@@ -97,15 +89,22 @@ from .models import (
     BattleTag,
     Gamertag,
     GuildConfigJson,
-    Handle,
-    HighscoreCron,
     OnlineID,
     Role,
-    SR,
     User,
     WelcomeMessage,
 )
+from .srgraph import SRGraphRenderer
+from .stats import trimmed_means
 from .utils import (
+    FETCH_SCHEDULER,
+    PROFILE_CACHE_STATS,
+    ChannelRenameScheduler,
+    GuildMemberIndex,
+    NickRefreshProgress,
+    SyncScheduler,
+    TokenBucket,
+    WEB_PROFILE_UUID_CACHE,
     TDS,
     get_sr,
     reply,
@@ -116,8 +115,6 @@ from .utils import (
     sr_to_rank,
 )
 
-matplotlib.use("Agg")  # noqa
-
 
 logger = logging.getLogger("orisa")
 
@@ -188,6 +185,22 @@ COLORS = (
 )
 
 
+# number of handles that are fetched concurrently and then written in one transaction
+SYNC_BATCH_SIZE = 50
+SYNC_BATCH_WORKERS = 2
+
+# voice state changes of a category within this many seconds are handled
+# by a single adjustment of its channels
+VOICE_ADJUST_DELAY = 2
+
+# bulk nick refreshes: concurrent nick updates, and how many per second and guild
+NICK_REFRESH_WORKERS = 8
+NICK_REFRESH_RATE = 2
+
+# highscore tables of all guilds are posted concurrently, limited to this many
+# messages per second in total
+HIGHSCORE_POST_RATE = 5
+
 PROFILER = __import__("cProfile").Profile()
 PROFILER.disable()
 
@@ -227,13 +240,6 @@ def rank_fmt(sr, short=False):
     div = 5 - (sr // 100 % 5)
     return f"{_(RANKS[rank])}{div}" if short else f"{_(FULL_RANKS[rank])} {div}"
 
-@dataclass
-class ChannelRenameLimit:
-    lock: trio.Lock
-    reset_time: float
-    remaining: int
-
-
 # Main Orisa code
 class Orisa(Plugin):
 
@@ -251,13 +257,25 @@ class Orisa(Plugin):
         self.dialogues = {}
         self.web_send_ch, self.web_recv_ch = trio.open_memory_channel(5)
         self.raven_client = raven_client
-        self.sync_cache = cachetools.TTLCache(maxsize=1000, ttl=30)
         self.stopped_playing_cache = cachetools.TTLCache(maxsize=1000, ttl=10)
+        self.sync_scheduler = SyncScheduler()
 
         self.guild_config = defaultdict(GuildConfig.default)
 
-        self._new_channel_name = {}
-        self._channel_rename_limit = cachetools.LRUCache(maxsize=1000)
+        self._pending_voice_adjusts = {}
+        self._voice_adjust_locks = defaultdict(trio.Lock)
+        self._channel_renamer = ChannelRenameScheduler(self._perform_rename)
+        self._srgraphs = SRGraphRenderer()
+        # (guild_id, role, locale, style) -> (digest, messages) of the last posted board
+        self._highscore_boards = {}
+        self._highscore_bucket = TokenBucket(
+            rate=HIGHSCORE_POST_RATE, capacity=HIGHSCORE_POST_RATE
+        )
+        self._member_index = GuildMemberIndex()
+        # (format, SRs, has secondaries, locale) -> formatted nick fragment
+        self._formatted_nicks = cachetools.LRUCache(maxsize=5000)
+        # guild id -> NickRefreshProgress of the latest bulk refresh
+        self.nick_refreshes = cachetools.TTLCache(maxsize=1000, ttl=3600)
 
         self._welcome_language = cachetools.LRUCache(maxsize=500)
 
@@ -278,6 +296,8 @@ class Orisa(Plugin):
         )
 
     async def load(self):
+        for guild in self.client.guilds.values():
+            self._member_index.guild_changed(guild)
 
         async with self.database.session() as session:
             for config in await run_sync(
@@ -289,6 +309,13 @@ class Orisa(Plugin):
                     config.config
                 )
 
+            WEB_PROFILE_UUID_CACHE.load(
+                await self.database.get_web_profile_resolutions(session)
+            )
+            logger.info(
+                "loaded %d web profile resolutions", len(WEB_PROFILE_UUID_CACHE)
+            )
+
         logger.warn("TEMPORARILY NOT SENDING MESSAGES TO GUILDS!")
         # await self.spawn(self._message_new_guilds)
 
@@ -297,6 +324,8 @@ class Orisa(Plugin):
         logger.info("spawning cron")
         await self.spawn(self._cron_task)
 
+        await self.spawn(self._channel_renamer.run)
+
         await self.spawn(self._web_server)
 
         await self.spawn(self._oauth_result_listener)
@@ -508,18 +537,30 @@ class Orisa(Plugin):
 
         await self._top_players([guild_id], style, update_cron=False)
 
+    @command()
+    @condition(only_owner)
+    async def syncstats(self, ctx):
+        stats = FETCH_SCHEDULER.stats()
+        await reply(
+            ctx,
+            f"concurrency {stats.concurrency}, rate {stats.rate:.2f}/s, "
+            f"{stats.requests_per_second:.2f} requests/s, "
+            f"latency {stats.latency or 0:.2f}s, error rate {stats.error_rate:.1%}\n"
+            f"{PROFILE_CACHE_STATS}",
+        )
+
     @command()
     @condition(only_owner)
     async def updatenicks(self, ctx):
-        async with self.database.session() as session:
-            for user in await run_sync(session.query(User).all):
-                try:
-                    await self._update_nick(user)
-                except Exception:
-                    if self.raven_client:
-                        self.raven_client.captureException()
-                    logger.exception("something went wrong during updatenicks")
-            await ctx.channel.messages.send("Done")
+        progress = NickRefreshProgress()
+        await ctx.channel.messages.send("Refreshing nicks…")
+        try:
+            await self._refresh_nicks(self._configured_guilds(), progress)
+        except Exception:
+            if self.raven_client:
+                self.raven_client.captureException()
+            logger.exception("something went wrong during updatenicks")
+        await ctx.channel.messages.send(f"Done: {progress}")
 
     @command()
     @condition(only_owner, bypass_owner=False)
@@ -556,7 +597,7 @@ class Orisa(Plugin):
                         await run_sync(session.delete, user)
                         logger.info(f"deleted guild config {id}")
                 for id in stale_guild_configs:
-                    gc = session.query(GuildConfigJson).filter_by(id=id).one_or_none()
+                    gc = await self.database.guild_config_by_id(session, id)
                     if not gc:
                         await ctx.channel.messages.send(
                             f"guild config {id} not found in DB???"
@@ -1256,7 +1297,9 @@ Retail Jedi"""
                 async with ctx.channel.typing:
                     for handle in user.handles:
                         try:
-                            await self._sync_handle(session, handle)
+                            # also needs to work when the profile didn't change,
+                            # e.g. to fix a nick that couldn't be updated before
+                            await self._sync_handle(session, handle, force=True)
                         except InvalidBattleTag:
                             await reply(
                                 ctx,
@@ -1299,7 +1342,7 @@ Retail Jedi"""
                 logger.info(f"{ctx.author.name} ({ctx.author.id}) requested removal")
                 user_id = user.discord_id
                 try:
-                    for guild in self._configured_guilds():
+                    for guild in self._configured_guilds_of(user_id):
                         try:
                             nn = str(guild.members[user_id].name)
                         except KeyError:
@@ -1311,7 +1354,7 @@ Retail Jedi"""
                             pass
                 except Exception:
                     logger.exception("Some problems while resetting nicks")
-                session.delete(user)
+                await run_sync(session.delete, user)
                 await reply(
                     ctx,
                     _("OK, deleted {name} from database").format(name=ctx.author.name),
@@ -1455,10 +1498,9 @@ Retail Jedi"""
                 channel_id = g_conf.listen_channel_id
 
         if not channel_id:
-            for guild in self._configured_guilds():
-                if ctx.author.id in guild.members:
-                    channel_id = self.guild_config[guild.id].listen_channel_id
-                    break
+            for guild in self._configured_guilds_of(ctx.author.id):
+                channel_id = self.guild_config[guild.id].listen_channel_id
+                break
 
         embed = Embed(
             title=_("Orisa's purpose"),
@@ -1709,7 +1751,7 @@ Retail Jedi"""
                     )
                     return
                 else:
-                    await self._srgraph(ctx, user, ctx.author.name, date)
+                    await self._srgraph(ctx, session, user, ctx.author.name, date)
 
     @ow.subcommand()
     @author_has_roles("Orisa Admin")
@@ -1726,7 +1768,7 @@ Retail Jedi"""
                     )
                     return
                 else:
-                    await self._srgraph(ctx, user, member.name, date)
+                    await self._srgraph(ctx, session, user, member.name, date)
 
     @ow.subcommand()
     async def privacy(self, ctx):
@@ -1751,10 +1793,11 @@ Retail Jedi"""
                     filename = tmp.name
                     with pd.ExcelWriter(filename, engine="openpyxl") as xls_wr:
                         for handle in user.handles:
+                            history = await self.database.sr_history(session, handle)
                             df = pd.DataFrame.from_records(
                                 [
                                     (sr.timestamp, sr.tank, sr.damage, sr.support)
-                                    for sr in handle.sr_history
+                                    for sr in history
                                 ],
                                 columns=[
                                     _("Timestamp"),
@@ -1794,14 +1837,11 @@ Retail Jedi"""
                 if not ctx.channel.private:
                     await reply(ctx, "I've sent you a DM.")
 
-    async def _srgraph(self, ctx, user, name, date: str = None):
-        sns.set_theme(font="Lato")
-
+    async def _srgraph(self, ctx, session, user, name, date: str = None):
         handle = user.handles[0]
+        current_sr = handle.current_sr
 
-        data = [(sr.timestamp, *sr.values) for sr in handle.sr_history]
-
-        if not data:
+        if current_sr is None:
             await ctx.channel.messages.send(
                 _("There is no data yet for {handle}, try again later").format(
                     handle=handle.handle
@@ -1809,20 +1849,6 @@ Retail Jedi"""
             )
             return
 
-        data = pd.DataFrame.from_records(
-            reversed(data),
-            columns=["timestamp", _("Tank"), _("Damage"), _("Support")],
-            index="timestamp",
-        )
-
-        for row in [_("Tank"), _("Damage"), _("Support")]:
-            if data[row].isnull().all():
-                data.drop(row, axis=1, inplace=True)
-
-        if len(data.columns) == 0:
-            await reply(ctx, _("I have no SR for your account stored yet."))
-            return
-
         if date:
             try:
                 date = date_parser.isoparse(date)
@@ -1841,28 +1867,30 @@ Retail Jedi"""
                     )
                     return
 
-            data = data[data.index >= date]
-
-        fig, ax = plt.subplots()
-
-        ax.xaxis_date()
+        # update_sr rewrites the newest SR in place when the SR plateaus,
+        # so its id alone doesn't tell whether the graph changed
+        key = (
+            handle.id,
+            date,
+            current_sr.id,
+            current_sr.timestamp,
+            current_sr.values,
+            CurrentLocale.get(),
+        )
+        image = self._srgraphs.cached(key)
+        if image is None:
+            timestamps, *columns = await self.database.sr_history_columns(
+                session, handle, since=date
+            )
 
-        sns.lineplot(data=data, ax=ax, drawstyle="steps-post", dashes=True)
+            if timestamps and all(value is None for col in columns for value in col):
+                await reply(ctx, _("I have no SR for your account stored yet."))
+                return
 
-        ax.xaxis.set_major_formatter(matplotlib.dates.DateFormatter("%Y-%m-%d"))
-        ax.yaxis.set_major_locator(
-            matplotlib.ticker.MaxNLocator(
-                nbins="auto", steps=[1, 1.25, 2.5, 5], integer=True
+            image = await self._srgraphs.render(
+                key, timestamps, columns, [_("Tank"), _("Damage"), _("Support")]
             )
-        )
-        fig.autofmt_xdate()
 
-        plt.xlabel("Date")
-        plt.ylabel("SR")
-
-        image = BytesIO()
-        plt.savefig(format="png", fname=image, transparent=False)
-        image.seek(0)
         embed = Embed(
             title=_("SR History For {name}").format(name=name),
             description=_("Here is your SR history starting from {date}").format(
@@ -1948,52 +1976,24 @@ Retail Jedi"""
         if old_voice_state and old_voice_state.channel:
             parent = old_voice_state.channel.parent
             if parent:
-
-                async def task():
-                    try:
-                        await self._adjust_voice_channels(parent)
-                    except Exception:
-                        logger.warn(
-                            f"Can't adjust voice channel for parent {parent}",
-                            exc_info=True,
-                        )
-
-                await self.spawn(task)
+                await self._schedule_voice_adjust(parent)
 
         if new_voice_state and new_voice_state.channel:
-            if new_voice_state.channel.parent != parent:
-                if new_voice_state.channel.parent:
-
-                    async def task():
-                        try:
-                            await self._adjust_voice_channels(
-                                new_voice_state.channel.parent
-                            )
-                        except Exception:
-                            if new_voice_state.channel:
-                                logger.warn(
-                                    f"Can't adjust voice channel for new state parent {new_voice_state.channel.parent}",
-                                    exc_info=True,
-                                )
-                            else:
-                                logger.warn(
-                                    f"Can't adjust voice channel for new state (channel is none) {new_voice_state}",
-                                    exc_info=True,
-                                )
-
-                    await self.spawn(task)
+            new_parent = new_voice_state.channel.parent
+            if new_parent and new_parent != parent:
+                await self._schedule_voice_adjust(new_parent)
 
         CurrentLocale.set(self.guild_config[member.guild_id].locale)
-        async with self.database.session() as session:
-            user = await self.database.user_by_discord_id(session, member.id)
-            if user:
-                formatted = self._format_nick(user)
-                try:
-                    await self._update_nick_for_member(member, formatted)
-                except Exception:
-                    logger.warn(
-                        "Unable to update nick for member %s", member, exc_info=True
-                    )
+        user = await self.database.user_snapshot(member.id)
+        # users without handles are still registering
+        if user and user.handle_ids:
+            formatted = self._format_nick(
+                user.format, user.nick_sr, user.has_secondaries
+            )
+            try:
+                await self._update_nick_for_member(member, formatted, user)
+            except Exception:
+                logger.warn("Unable to update nick for member %s", member, exc_info=True)
 
     @event("message_create")
     async def _message_create(self, ctx, msg):
@@ -2013,23 +2013,33 @@ Retail Jedi"""
             len(self.client.guilds),
         )
         async with self.database.session() as session:
-            gc = session.query(GuildConfigJson).filter_by(id=guild.id).one_or_none()
+            gc = await self.database.guild_config_by_id(session, guild.id)
             if gc:
                 logger.info("That guild was configured")
-                session.delete(gc)
-            cron = session.query(HighscoreCron).filter_by(id=guild.id).one_or_none()
+                await run_sync(session.delete, gc)
+            cron = await self.database.highscore_cron_by_id(session, guild.id)
             if cron:
                 logger.info("That guild had a cron configured")
-                session.delete(cron)
+                await run_sync(session.delete, cron)
             with suppress(KeyError):
                 del self.guild_config[guild.id]
             await run_sync(session.commit)
+        self._member_index.remove_guild(guild)
+
+    @event("guild_chunk")
+    async def _guild_chunk(self, ctx, guild, count):
+        self._member_index.guild_changed(guild)
+
+    @event("guild_member_add")
+    async def _guild_member_add(self, ctx, member):
+        self._member_index.add(member.id, member.guild_id)
 
     @event("guild_member_remove")
     async def _guild_member_remove(self, ctx: Context, member: Member):
         logger.debug(
             f"Member {member.name}({member.id}) left the guild ({member.guild})"
         )
+        self._member_index.remove(member.id, member.guild_id)
         if member.id == ctx.bot.user.id:
             # seems we got the remove_member event instead of the member_leave event?
             logger.info("Seems like I was kicked from guild %s", member.guild)
@@ -2039,17 +2049,25 @@ Retail Jedi"""
             async with self.database.session() as session:
                 user = await self.database.user_by_discord_id(session, member.id)
                 if user:
-                    in_other_guild = False
-                    for guild in self.client.guilds.values():
-                        if guild.id != member.guild.id and member.id in guild.members:
-                            in_other_guild = True
-                            logger.debug(f"{member.name} is still in guild {guild.id}")
-                            break
-                    if not in_other_guild:
+                    # the index can still contain guilds the member has left, so
+                    # check the member lists, like _configured_guilds_of does
+                    other_guild_ids = [
+                        guild_id
+                        for guild_id in self._member_index.guild_ids_of(member.id)
+                        if guild_id != member.guild_id
+                        and guild_id in self.client.guilds
+                        and member.id in self.client.guilds[guild_id].members
+                    ]
+                    in_other_guild = bool(other_guild_ids)
+                    if in_other_guild:
+                        logger.debug(
+                            f"{member.name} is still in guilds {other_guild_ids}"
+                        )
+                    else:
                         logger.info(
                             f"deleting {user} from database because {member.name} left the guild and has no other guilds"
                         )
-                        session.delete(user)
+                        await run_sync(session.delete, user)
                         await run_sync(session.commit)
 
     @event("gateway_dispatch_received")
@@ -2229,7 +2247,42 @@ Retail Jedi"""
 
     # Util
 
-    async def _adjust_voice_channels(
+    async def _schedule_voice_adjust(self, parent):
+        "Adjusts the voice channels of parent soon, coalescing requests that arrive in the meantime"
+        parent_id = parent.id
+        already_pending = parent_id in self._pending_voice_adjusts
+        # keep the newest channel object, it reflects the latest state
+        self._pending_voice_adjusts[parent_id] = parent
+        if already_pending:
+            return
+
+        async def task():
+            await trio.sleep(VOICE_ADJUST_DELAY)
+            # requests arriving from now on start a new round
+            latest_parent = self._pending_voice_adjusts.pop(parent_id)
+            try:
+                await self._adjust_voice_channels(latest_parent)
+            except Exception:
+                logger.warn(
+                    f"Can't adjust voice channels for parent {latest_parent}",
+                    exc_info=True,
+                )
+
+        await self.spawn(task)
+
+    async def _adjust_voice_channels(self, parent, **kwargs):
+        # never reconcile the same category concurrently
+        lock = self._voice_adjust_locks[parent.id]
+        try:
+            async with lock:
+                await self._reconcile_voice_channels(parent, **kwargs)
+        finally:
+            # a released lock is handed over to the next waiter directly, so if it's
+            # free now, nobody needs it anymore
+            if not lock.locked() and self._voice_adjust_locks.get(parent.id) is lock:
+                del self._voice_adjust_locks[parent.id]
+
+    async def _reconcile_voice_channels(
         self, parent, *, create_all_channels=False, adjust_user_limits=False
     ):
         guild = parent.guild
@@ -2375,56 +2428,75 @@ Retail Jedi"""
 
             final_list = []
 
-            async def channel_suffix(session, chan):
-                srs = await self.database.get_srs(
-                    session, [member.id for member in chan.voice_members if member]
+            def channel_suffixes(chans, srs_by_id):
+                "SR suffixes for all chans, computed in one go"
+                rows = []
+                chan_ixs = []
+                for chan_ix, chan in enumerate(chans):
+                    for member in chan.voice_members:
+                        if member and member.id in srs_by_id:
+                            rows.append(srs_by_id[member.id])
+                            chan_ixs.append(chan_ix)
+
+                means, counts = trimmed_means(
+                    np.array(rows, dtype=float).reshape(-1, 3), chan_ixs, len(chans)
+                )
+                members = np.bincount(
+                    np.array(chan_ixs, dtype=np.intp), minlength=len(chans)
                 )
 
-                combined = np.array([sr.values for sr in srs], dtype=np.float)
-
-                if not any(x is not None for x in combined):
-                    return ""
-
-                # hide useless warning in case we take the mean of an empty slice
-                with warnings.catch_warnings():
-
-                    tds_filtered_mean = [
-                        0
-                        if np.all(np.isnan(x))
-                        else np.nanmean(x[np.abs(x - np.nanmean(x)) <= 750])
-                        for x in combined.T
-                    ]
-
-                def val(x):
-                    return (
-                        "xx" if np.isnan(x) else "⊘" if x == 0 else f"{int(x//100):02}"
+                def val(mean, count):
+                    if count == 0:
+                        return "⊘"
+                    elif np.isnan(mean):
+                        # every value is an outlier
+                        return "xx"
+                    else:
+                        return f"{int(mean//100):02}"
+
+                return {
+                    chan.id: f" [{'-'.join(map(val, means[ix], counts[ix]))}]"
+                    if members[ix]
+                    else ""
+                    for ix, chan in enumerate(chans)
+                }
+
+            suffixes = {}
+            if cat.show_sr_in_nicks:
+                all_chans = [chan for chans in managed_group.values() for chan in chans]
+                # one lookup for the whole category
+                async with self.database.session() as session:
+                    srs_by_id = await self.database.get_primary_srs(
+                        session,
+                        {
+                            member.id
+                            for chan in all_chans
+                            for member in chan.voice_members
+                            if member
+                        },
                     )
-
-                return f" [{'-'.join(val(x) for x in tds_filtered_mean)}]"
+                suffixes = channel_suffixes(all_chans, srs_by_id)
 
             for prefix, prefix_info in prefix_map.items():
                 chans = managed_group[prefix]
                 # rename channels if necessary
-                async with self.database.session() as session:
-                    for i, chan in enumerate(chans):
-                        if cat.show_sr_in_nicks:
-                            new_name = (
-                                f"{prefix} #{i+1}{await channel_suffix(session, chan)}"
-                            )
-                        else:
-                            new_name = f"{prefix} #{i+1}"
+                for i, chan in enumerate(chans):
+                    if cat.show_sr_in_nicks:
+                        new_name = f"{prefix} #{i+1}{suffixes[chan.id]}"
+                    else:
+                        new_name = f"{prefix} #{i+1}"
 
-                        try:
-                            await self._rename_channel(chan, new_name)
-                            if adjust_user_limits:
-                                limit = prefix_info.limit
-                                await chan.edit(user_limit=limit)
-                        except NotFound:
-                            logger.warn(
-                                "Tried to change a channel that Discord says does not exist, removing it from cache!",
-                                exc_info=True,
-                            )
-                            chan.guild._channels.pop(chan.id, None)
+                    try:
+                        await self._rename_channel(chan, new_name)
+                        if adjust_user_limits:
+                            limit = prefix_info.limit
+                            await chan.edit(user_limit=limit)
+                    except NotFound:
+                        logger.warn(
+                            "Tried to change a channel that Discord says does not exist, removing it from cache!",
+                            exc_info=True,
+                        )
+                        chan.guild._channels.pop(chan.id, None)
 
                 final_list.extend(chans)
 
@@ -2442,54 +2514,70 @@ Retail Jedi"""
                     else 1
                 )
 
+            async def move_channel(chan, pos):
+                try:
+                    try:
+                        await chan.edit(position=pos)
+                    except:
+                        logger.error(
+                            "cannot edit channel %s, effective permissions %s",
+                            chan,
+                            chan.effective_permissions(guild.me),
+                        )
+                        raise
+                except NotFound:
+                    logger.warn(
+                        "Tried to change a channel that Discord says does not exist, removing from cache!",
+                        exc_info=True,
+                    )
+                    chan.guild._channels.pop(chan.id, None)
+
+            moves = []
             pos = start_pos - 1
             for chan in final_list:
                 pos += 1
                 if pos < 100 and chan in unmanaged_set:
                     pos = 100
                 if chan.position != pos:
-                    try:
-                        try:
-                            await chan.edit(position=pos)
-                        except:
-                            logger.error(
-                                "cannot edit channel %s, effective permissions %s",
-                                chan,
-                                chan.effective_permissions(guild.me),
-                            )
-                            raise
-                        await trio.sleep(0.5)  #  FIXME: temporary hack
-                    except NotFound:
-                        logger.warn(
-                            "Tried to change a channel that Discord says does not exist, removing from cache!",
-                            exc_info=True,
-                        )
-                        chan.guild._channels.pop(chan.id, None)
-
-    def _format_nick(self, user):
-        primary = user.handles[0]
+                    moves.append((chan, pos))
 
-        if primary.sr:
-            all_sr = primary.sr
-        else:
-            all_sr = TDS(None, None, None)
-
-        if any(x is None for x in all_sr):
-            # normally, we only save different values for SR, so if there is
-            # a non null value, it should be the second or third, but just
-            # to be sure, check the first 10...
-            # negative value means it's an old one
-            for old_sr in primary.sr_history[:10]:
-                if old_sr.timestamp < datetime(2023, 1, 1):
-                    break
-                if old_sr.values:
-                    all_sr = TDS(
-                        *[av or (ov and -ov) for av, ov in zip(all_sr, old_sr.values)]
+            if len(moves) == 1:
+                # the bulk endpoint needs at least two channels
+                await move_channel(*moves[0])
+            elif moves:
+                logger.debug("moving %d channels in %s", len(moves), parent)
+                try:
+                    await self.client.http.update_channel_positions(
+                        guild.id, [(chan.id, pos) for chan, pos in moves]
                     )
-                if all(x is not None for x in all_sr):
-                    break
+                except NotFound:
+                    logger.warn(
+                        "Bulk move of channels in %s failed, moving them one by one",
+                        parent,
+                        exc_info=True,
+                    )
+                    for chan, pos in moves:
+                        await move_channel(chan, pos)
+                except:
+                    logger.error(
+                        "cannot move channels in %s, effective permissions %s",
+                        parent,
+                        parent.effective_permissions(guild.me),
+                    )
+                    raise
 
-        has_secondaries = len(user.handles) > 1
+    def _format_nick(self, format, all_sr, has_secondaries):
+        # the result depends on the locale because of the rank names
+        key = (format, all_sr, has_secondaries, CurrentLocale.get())
+        try:
+            return self._formatted_nicks[key]
+        except KeyError:
+            formatted = self._formatted_nicks[key] = self._render_nick(
+                format, all_sr, has_secondaries
+            )
+            return formatted
+
+    def _render_nick(self, format, all_sr, has_secondaries):
 
         def val_str(val, short=False):
             if val is None:
@@ -2517,7 +2605,7 @@ Retail Jedi"""
         else:
             sec_mark = ""
 
-        t = Template(user.format)
+        t = Template(format)
         try:
             return (
                 t.substitute(
@@ -2552,91 +2640,47 @@ Retail Jedi"""
 
     async def _rename_channel(self, channel, new_name):
         """
-        Discord only allows 2 renames within 10 minutes (per channel), so we have to enforce that
-        limit somehow
+        Discord only allows 2 renames within 10 minutes (per channel), so renames
+        are queued and performed when the channel's limit allows it
         """
-        # logger.debug("got a request to rename channel %s to %s", channel, new_name)
+        self._channel_renamer.request(channel, new_name)
 
-        self._new_channel_name[channel.id] = new_name
-
-        async def perform_rename():
-            # 10 minutes + 2 seconds safety margin
-            reset_interval = 602
-            try:
-                try:
-                    limit = self._channel_rename_limit[channel.id]
-                except KeyError:
-                    limit = ChannelRenameLimit(
-                        lock=trio.Lock(), reset_time=None, remaining=2
-                    )
-                    self._channel_rename_limit[channel.id] = limit
-
-                # logger.debug("Trying to acquire lock for channel %s", channel)
-                async with limit.lock:
-                    # logger.debug("Lock for channel %s acquired", channel)
-                    if not limit.remaining:
-                        to_sleep = limit.reset_time - time.time()
-                        if to_sleep >= 0:
-                            logger.debug(
-                                "Rate limit for channel %s reached, sleeping %f s",
-                                channel,
-                                to_sleep,
-                            )
-                            await trio.sleep(to_sleep)
-
-                        # reset limits
-                        limit.reset_time = None
-                        limit.remaining = 2
-
-                    new_name = self._new_channel_name.get(channel.id)
-
-                    if not new_name:
-                        # logger.debug("no new name for channel %s, assuming it has already been renamed", channel)
-                        return
-
-                    # channel object/name might have changed in the meantime, so acquire it again
-
-                    up_to_date_channel = channel.guild.channels.get(channel.id)
-                    if not up_to_date_channel:
-                        # logger.debug("Channel %s not found in channels list, assuming it has been deleted by now", channel)
-                        pass
-                    elif up_to_date_channel.name == new_name:
-                        # logger.debug("no need to rename channel %s to %s, as it already has the correct name", up_to_date_channel, new_name)
-                        pass
-                    else:
-                        logger.debug(
-                            "renaming channel %s to %s", up_to_date_channel, new_name
-                        )
-                        try:
-                            await up_to_date_channel.edit(name=new_name)
-                        except NotFound:
-                            logger.warn(
-                                "Tried to change a channel that Discord says does not exist, removing from cache!",
-                                exc_info=True,
-                            )
-                            channel.guild._channels.pop(channel.id, None)
-                        if limit.reset_time is None:
-                            limit.reset_time = time.time() + reset_interval
-                        limit.remaining -= 1
+    async def _perform_rename(self, channel, new_name):
+        "Renames the channel if necessary, returns whether Discord was asked to rename it"
 
-                    del self._new_channel_name[channel.id]
-            except Exception:
-                logger.exception("Unhandled exception in perform_rename")
+        # channel object/name might have changed in the meantime, so acquire it again
+        up_to_date_channel = channel.guild.channels.get(channel.id)
+        if not up_to_date_channel:
+            # deleted by now
+            return False
+        elif up_to_date_channel.name == new_name:
+            return False
 
-        await self.spawn(perform_rename)
+        logger.debug("renaming channel %s to %s", up_to_date_channel, new_name)
+        try:
+            await up_to_date_channel.edit(name=new_name)
+        except NotFound:
+            logger.warn(
+                "Tried to change a channel that Discord says does not exist, removing from cache!",
+                exc_info=True,
+            )
+            channel.guild._channels.pop(channel.id, None)
+        return True
 
     async def _update_nick(self, user, *, force=False, raise_hierachy_error=False):
         user_id = user.discord_id
         exception = new_nn = None
+        all_sr = await self.database.nick_sr(object_session(user), user)
+        has_secondaries = len(user.handles) > 1
 
-        for guild in self._configured_guilds():
+        for guild in self._configured_guilds_of(user_id):
             try:
                 member = guild.members[user_id]
             except KeyError:
                 continue
             try:
                 CurrentLocale.set(self.guild_config[guild.id].locale)
-                formatted = self._format_nick(user)
+                formatted = self._format_nick(user.format, all_sr, has_secondaries)
                 new_nn = await self._update_nick_for_member(
                     member,
                     formatted,
@@ -2663,20 +2707,7 @@ Retail Jedi"""
         raise_hierachy_error=False,
     ):
         nn = str(member.name)
-
-        if force or await self._show_sr_in_nick(member, user):
-            if re.search(r"\[.*?\]", str(nn)):
-                new_nn = re.sub(r"\[.*?\]", f"[{formatted}]", nn)
-            else:
-                new_nn = f"{nn} [{formatted}]"
-        else:
-            if re.search(r"\[.*?\]", str(nn)):
-                new_nn = re.sub(r"\[.*?\]", "", nn)
-            else:
-                new_nn = nn
-
-        if len(new_nn) > 32:
-            raise NicknameTooLong(new_nn)
+        new_nn = await self._desired_nick(member, formatted, user, force=force)
 
         if nn != new_nn:
             logger.debug("New nick for %s is %s", nn, new_nn)
@@ -2696,13 +2727,104 @@ Retail Jedi"""
 
         return new_nn
 
+    async def _desired_nick(self, member, formatted: str, user=None, *, force=False):
+        nn = str(member.name)
+
+        if force or await self._show_sr_in_nick(member, user):
+            if re.search(r"\[.*?\]", str(nn)):
+                new_nn = re.sub(r"\[.*?\]", f"[{formatted}]", nn)
+            else:
+                new_nn = f"{nn} [{formatted}]"
+        else:
+            if re.search(r"\[.*?\]", str(nn)):
+                new_nn = re.sub(r"\[.*?\]", "", nn)
+            else:
+                new_nn = nn
+
+        if len(new_nn) > 32:
+            raise NicknameTooLong(new_nn)
+
+        return new_nn
+
+    async def _refresh_nicks(self, guilds, progress):
+        """Brings the nicks of all registered members of the guilds up to date.
+
+        The new nicks are computed in memory first, only actual changes are sent
+        to Discord, by a pool of workers that respects a per guild rate."""
+
+        try:
+            guilds = {
+                guild.id: guild for guild in guilds if guild.id in self.guild_config
+            }
+            changes = []
+
+            async with self.database.session() as session:
+                users = await self.database.users_by_discord_ids(
+                    session,
+                    {id for guild in guilds.values() for id in guild.members.keys()},
+                )
+                users = [user for user in users if user.handles]
+                nick_srs = await self.database.nick_srs(session, users)
+
+            for user in users:
+                has_secondaries = len(user.handles) > 1
+                for guild_id in self._member_index.guild_ids_of(user.discord_id):
+                    try:
+                        member = guilds[guild_id].members[user.discord_id]
+                    except KeyError:
+                        continue
+                    CurrentLocale.set(self.guild_config[guild_id].locale)
+                    try:
+                        formatted = self._format_nick(
+                            user.format, nick_srs[user.id], has_secondaries
+                        )
+                        new_nn = await self._desired_nick(member, formatted, user)
+                    except (InvalidFormat, NicknameTooLong):
+                        progress.failed += 1
+                        continue
+                    finally:
+                        progress.checked += 1
+                    if new_nn != str(member.name):
+                        changes.append((member, new_nn))
+
+            progress.to_change = len(changes)
+            buckets = defaultdict(
+                lambda: TokenBucket(rate=NICK_REFRESH_RATE, capacity=NICK_REFRESH_RATE)
+            )
+
+            async def worker(recv_ch):
+                async for member, new_nn in recv_ch:
+                    await buckets[member.guild_id].acquire()
+                    try:
+                        await member.nickname.set(new_nn)
+                    except Exception:
+                        logger.info(
+                            "Cannot update nick of %s to %s",
+                            member,
+                            new_nn,
+                            exc_info=True,
+                        )
+                        progress.failed += 1
+                    else:
+                        progress.changed += 1
+
+            send_ch, recv_ch = trio.open_memory_channel(0)
+            async with trio.open_nursery() as nursery:
+                for i in range(NICK_REFRESH_WORKERS):
+                    nursery.start_soon(worker, recv_ch.clone())
+                await recv_ch.aclose()
+                async with send_ch:
+                    for change in changes:
+                        await send_ch.send(change)
+        finally:
+            progress.finished = True
+
     async def _show_sr_in_nick(self, member, user):
         if self.guild_config[member.guild_id].show_sr_in_nicks_by_default:
             return True
 
         if not user:
-            async with self.database.session() as session:
-                user = await self.database.user_by_discord_id(session, member.id)
+            user = await self.database.user_snapshot(member.id)
 
         if user.always_show_sr:
             return True
@@ -2725,10 +2847,8 @@ Retail Jedi"""
     async def _send_congrats(self, handle, role_idx, sr, rank, image):
         user = handle.user
 
-        for guild in self._configured_guilds():
+        for guild in self._configured_guilds_of(user.discord_id):
             try:
-                if user.discord_id not in guild.members:
-                    continue
                 CurrentLocale.set(self.guild_config[guild.id].locale)
                 embed = Embed(
                     # Translators: Used when somebody reached a new rank. Replace with the localized voiceline that Orisa uses
@@ -2760,247 +2880,247 @@ Retail Jedi"""
                 logger.exception(f"Cannot send congrats for guild {guild}")
 
     async def _top_players(self, guild_ids, style="fancy_grid", update_cron=True):
-        def prev_sr(tag):
-            for sr in tag.sr_history[:30]:
-                prev_sr = sr
-                if sr.timestamp < datetime.now() - timedelta(days=1):
-                    break
-            return prev_sr
-
         async with self.database.session() as session:
+            ranked, previous = await self.database.leaderboards(session)
 
-            handles = {
-                (type_class, role): await run_sync(
-                    session.query(type_class)
-                    .options(joinedload(type_class.user))
-                    .join(type_class.current_sr)
-                    .order_by(desc(role))
-                    .filter(role != None)
-                    .filter(type_class.position == 0)
-                    .filter(type_class.current_sr.has(SR.timestamp >= datetime(2023, 1, 1)))
-                    .all
-                )
-                for role in [SR.tank, SR.damage, SR.support]
-                #for type_class in [BattleTag, Gamertag, OnlineID]
-                for type_class in [BattleTag]
-            }
-
-            def create_h_a_p():
-
-                return [
-                    (c, t, handle, prev_sr(handle))
-                    # for c in [BattleTag, Gamertag, OnlineID]
-                    for c in [BattleTag]
-                    for t in [SR.tank, SR.damage, SR.support]
-                    for handle in handles[c, t]
-                ]
-
-            handles_and_prev = await run_sync(create_h_a_p)
-
-            top_per_guild = {}
+        top_per_guild = {}
 
-            guilds = [
-                guild for guild in self.client.guilds.values() if guild.id in guild_ids
-            ]
+        guild_ids = frozenset(guild_ids)
 
-            for type_class, type, handle, prev_sr in handles_and_prev:
-                for guild in guilds:
+        # only BattleTags for now
+        type_class = BattleTag
+        for role, entries in ranked.items():
+            for entry in entries:
+                for guild_id in guild_ids & self._member_index.guild_ids_of(
+                    entry.discord_id
+                ):
                     try:
-                        member = guild.members[handle.user.discord_id]
+                        guild = self.client.guilds[guild_id]
+                        member = guild.members[entry.discord_id]
                     except KeyError:
-                        # logger.debug(f"member {handle.user.discord_id} not found for highscore, downloading")
-                        # try:
-                        #     member = await self.client.download_guild_member(guild.id, handle.user.discord_id)
-                        # except Exception:
-                        #     logger.warn(f"unable to download member {handle.user.discord_id}, ignoring")
-                        #     continue
-                        # if member:
-                        #     guild._members[handle.user.discord_id] = member
-                        # else:
-                        #     continue
                         continue
 
+                    prev_sr = previous.get(entry.handle_id)
                     top_per_guild.setdefault(guild.id, {}).setdefault(
-                        (type_class, type.key), []
-                    ).append((member, handle, getattr(prev_sr, type.key)))
-
-            def member_name(member):
-                name = str(member.name)
-                name = re.sub(r"\[.*?\]", "", name)
-                name = re.sub(r"\{.*?\}", "", name)
-                name = re.sub(r"\s{2,}", " ", name)
-
-                return "".join(
-                    ch if ord(ch) < 256 or unicodedata.category(ch)[0] != "S" else ""
-                    for ch in name
+                        (type_class, role), []
+                    ).append((member, entry, getattr(prev_sr, role, None)))
+
+        # render everything up front, so the posting below only waits for Discord
+        boards = {}
+        for guild_id, role_tops in top_per_guild.items():
+            logger.debug(f"Processing guild {guild_id} for top_players")
+            CurrentLocale.set(self.guild_config[guild_id].locale)
+            guild_boards = []
+            for (type_class, role), tops in role_tops.items():
+                key = (guild_id, role, CurrentLocale.get(), style)
+                digest, messages = self._render_top_players(
+                    key, type_class, role, tops, style
                 )
+                # the hs command (update_cron=False) always posts
+                last_posted = self._highscore_boards.get(key)
+                if update_cron and last_posted and last_posted[0] == digest:
+                    logger.debug("board %s unchanged, skipping", key)
+                    continue
+                guild_boards.append((key, digest, messages))
+            if guild_boards:
+                boards[guild_id] = guild_boards
 
-            for guild_id, role_tops in top_per_guild.items():
-                logger.debug(f"Processing guild {guild_id} for top_players")
-                CurrentLocale.set(self.guild_config[guild_id].locale)
-                for type_role, tops in role_tops.items():
-                    type_class, role = type_role
+        async with trio.open_nursery() as nursery:
+            for guild_id, guild_boards in boards.items():
+                nursery.start_soon(self._post_top_players, guild_id, guild_boards)
 
-                    # FIXME: wrong if there is a tie
-                    prev_top_tags = [
-                        top[1]
-                        for top in sorted(tops, key=lambda x: x[2] or 0, reverse=True)
-                    ]
+    def _render_top_players(self, key, type_class, role, tops, style):
+        """Returns (digest, messages) for one highscore table in the current locale.
 
-                    def prev_str(pos, tag, prev_sr):
-                        if not prev_sr:
-                            return "  (——)"
+        The table is only rendered again if its content differs from the
+        board last posted under key."""
 
-                        old_pos = prev_top_tags.index(tag) + 1
-                        if pos == old_pos:
-                            sym = " "
-                        elif pos > old_pos:
-                            sym = "↓"
-                        else:
-                            sym = "↑"
+        def member_name(member):
+            name = str(member.name)
+            name = re.sub(r"\[.*?\]", "", name)
+            name = re.sub(r"\{.*?\}", "", name)
+            name = re.sub(r"\s{2,}", " ", name)
 
-                        return f"{sym} ({old_pos:2})"
+            return "".join(
+                ch if ord(ch) < 256 or unicodedata.category(ch)[0] != "S" else ""
+                for ch in name
+            )
 
-                    def delta_fmt(curr, prev):
-                        if not curr or not prev or curr == prev:
-                            return ""
-                        else:
-                            return f"{(curr-prev)//100:+2}"
-
-
-                    table_prev_sr = None
-                    data = []
-                    for ix, (member, handle, prev_sr) in enumerate(tops):
-                        if getattr(handle.sr, role) != table_prev_sr:
-                            pos = ix + 1
-                        sr = getattr(handle.sr, role)
-                        table_prev_sr = sr
-                        data.append(
-                            (
-                                pos,
-                                prev_str(ix + 1, handle, prev_sr),
-                                member_name(member),
-                                member.id,
-                                rank_fmt(sr),
-                                delta_fmt(sr, prev_sr),
-                            )
-                        )
+        # FIXME: wrong if there is a tie
+        prev_top_tags = [
+            top[1] for top in sorted(tops, key=lambda x: x[2] or 0, reverse=True)
+        ]
 
-                    headers = [
-                        # Translators: header for highscore table: position (keep it short)
-                        _("#"),
-                        # Translators: header for highscore table: previous position (keep it short)
-                        _("prev"),
-                        # Translators: header for highscore table: member name
-                        _("Member"),
-                        # Translators: header for highscore table: member discord id
-                        _("Member ID"),
-                        # Translators: header for highscore table: Rank
-                        _("{role} Rank").format(role=_(role.capitalize())),
-                        # Translators: header for highscore table: Division difference
-                        _("ΔDiv"),
-                    ]
-                    csv_file = StringIO()
-                    csv_writer = csv.writer(csv_file)
-                    csv_writer.writerow(headers)
-                    csv_writer.writerows(data)
+        def prev_str(pos, tag, prev_sr):
+            if not prev_sr:
+                return "  (——)"
 
-                    csv_file = BytesIO(csv_file.getvalue().encode("utf-8"))
-                    csv_file.seek(0)
+            old_pos = prev_top_tags.index(tag) + 1
+            if pos == old_pos:
+                sym = " "
+            elif pos > old_pos:
+                sym = "↓"
+            else:
+                sym = "↑"
 
-                    def no_id(x):
-                        return x[:3] + x[4:]
+            return f"{sym} ({old_pos:2})"
 
-                    tabulate.PRESERVE_WHITESPACE = True
-                    table_lines = tabulate.tabulate(
-                        (no_id(e) for e in data), headers=no_id(headers), tablefmt=style
-                    ).split("\n")
+        def delta_fmt(curr, prev):
+            if not curr or not prev or curr == prev:
+                return ""
+            else:
+                return f"{(curr-prev)//100:+2}"
+
+        table_prev_sr = None
+        data = []
+        for ix, (member, entry, prev_sr) in enumerate(tops):
+            if getattr(entry.sr, role) != table_prev_sr:
+                pos = ix + 1
+            sr = getattr(entry.sr, role)
+            table_prev_sr = sr
+            data.append(
+                (
+                    pos,
+                    prev_str(ix + 1, entry, prev_sr),
+                    member_name(member),
+                    member.id,
+                    rank_fmt(sr),
+                    delta_fmt(sr, prev_sr),
+                )
+            )
 
-                    # fancy_grid inserts a ├─────┼───────┤ after every line, let's get rid of it
-                    if style == "fancy_grid":
-                        table_lines = [
-                            line for line in table_lines if not line.startswith("├")
-                        ]
+        headers = [
+            # Translators: header for highscore table: position (keep it short)
+            _("#"),
+            # Translators: header for highscore table: previous position (keep it short)
+            _("prev"),
+            # Translators: header for highscore table: member name
+            _("Member"),
+            # Translators: header for highscore table: member discord id
+            _("Member ID"),
+            # Translators: header for highscore table: Rank
+            _("{role} Rank").format(role=_(role.capitalize())),
+            # Translators: header for highscore table: Division difference
+            _("ΔDiv"),
+        ]
+        digest = hashlib.sha1(repr((headers, data)).encode("utf-8")).digest()
+        cached = self._highscore_boards.get(key)
+        if cached and cached[0] == digest:
+            return cached
 
-                    # Split table into submessages, because a short gap is visible after each message
-                    # we want it to be in "nice" multiples
+        def no_id(x):
+            return x[:3] + x[4:]
 
-                    ix = 0
-                    lines = 20
+        tabulate.PRESERVE_WHITESPACE = True
+        table_lines = tabulate.tabulate(
+            (no_id(e) for e in data), headers=no_id(headers), tablefmt=style
+        ).split("\n")
 
-                    try:
-                        logger.debug("trying to send highscore to %i…", guild_id)
-                        chan = self.client.find_channel(
-                            self.guild_config[guild_id].listen_channel_id
-                        )
-                        if not chan:
-                            logger.debug("no channel found")
-                            continue
-                        logger.debug("found channel %s", chan)
-                        send = chan.messages.send
-                        # send = self.client.application_info.owner.send
-                        await send(
-                            _(
-                                "Hello! Here are the current SRs for **{role}** on {platform}. If a member has more than one "
-                                "{handle_type}, only the primary {handle_type} is considered. Players with "
-                                "private profiles, or those that didn't do their placements this season yet "
-                                "are not shown."
-                            ).format(
-                                role=_(role.capitalize()),
-                                platform=type_class.blizzard_url_type.upper(),
-                                handle_type=_(type_class.desc),
-                            )
-                        )
-                        while ix < len(table_lines):
-                            # prefer splits at every "step" entry, but if it turns out too long, send a shorter message
-                            step = lines if ix else lines + 3
-                            await send_long(
-                                send,
-                                "```"
-                                + ("\n".join(table_lines[ix : ix + step]) + "```"),
-                            )
-                            ix += step
+        # fancy_grid inserts a ├─────┼───────┤ after every line, let's get rid of it
+        if style == "fancy_grid":
+            table_lines = [line for line in table_lines if not line.startswith("├")]
 
-                        # await chan.messages.upload(
-                        #    csv_file,
-                        #    filename=f"ranking_{role}_{type_class.blizzard_url_type.upper()}_{arrow.now().isoformat()[:10]}.csv",
-                        # )
-                        # logger.debug("upload done")
-                    except Exception:
-                        logger.exception(
-                            "unable to send top players to guild %i", guild_id
-                        )
+        messages = [
+            _(
+                "Hello! Here are the current SRs for **{role}** on {platform}. If a member has more than one "
+                "{handle_type}, only the primary {handle_type} is considered. Players with "
+                "private profiles, or those that didn't do their placements this season yet "
+                "are not shown."
+            ).format(
+                role=_(role.capitalize()),
+                platform=type_class.blizzard_url_type.upper(),
+                handle_type=_(type_class.desc),
+            )
+        ]
 
-                    # wait a bit before sending the next batch to avoid running into
-                    # rate limiting and sending data twice due to "timeouts"
-                    logger.debug("sleeping for 5s")
-                    await trio.sleep(5)
-                    logger.debug("done sleeping")
-                # one guild done
+        # Split table into submessages, because a short gap is visible after each message
+        # we want it to be in "nice" multiples
+
+        ix = 0
+        lines = 20
+
+        while ix < len(table_lines):
+            # prefer splits at every "step" entry, but if it turns out too long, send a shorter message
+            step = lines if ix else lines + 3
+            messages.append("```" + ("\n".join(table_lines[ix : ix + step]) + "```"))
+            ix += step
+
+        return digest, messages
+
+    async def _post_top_players(self, guild_id, boards):
+        try:
+            logger.debug("trying to send highscore to %i…", guild_id)
+            chan = self.client.find_channel(
+                self.guild_config[guild_id].listen_channel_id
+            )
+            if not chan:
+                logger.debug("no channel found")
+                return
+            logger.debug("found channel %s", chan)
+
+            async def send(content):
+                # all guilds post at the same time, so they share one limit
+                await self._highscore_bucket.acquire()
+                await chan.messages.send(content)
+
+            for key, digest, messages in boards:
+                for message in messages:
+                    await send_long(send, message)
+                self._highscore_boards[key] = (digest, messages)
+        except Exception:
+            logger.exception("unable to send top players to guild %i", guild_id)
 
     async def _message_new_guilds(self):
         for guild_id, guild in self.client.guilds.copy().items():
             if guild_id not in self.guild_config:
                 await self._handle_new_guild(guild)
 
-    async def _sync_handle(self, session, handle):
-        try:
-            srs, images = await get_sr(handle)
-        except UnableToFindSR:
+    def _apply_sync_result(self, handle, result):
+        """Applies the result of get_sr (or the exception it raised) to handle.
+
+        Returns (srs, images) if the new SR needs to be processed further"""
+        if isinstance(result, ProfileUnchanged):
+            logger.debug(f"Profile of {handle} is unchanged")
+            handle.error_count = 0
+            # SR is the same, so there are no nicks to update or congratulations to send,
+            # but we still need to update the last_update pseudo-column
+            handle.update_sr(handle.sr)
+            return None
+        elif isinstance(result, UnableToFindSR):
             logger.debug(f"No SR for {handle}, oh well…")
             srs = TDS(None, None, None)
             images = [None] * 3
-        except Exception:
+        elif isinstance(result, Exception):
             handle.error_count += 1
             # we need to update the last_update pseudo-column
             handle.update_sr(handle.sr)
             if self.raven_client:
-                self.raven_client.captureException()
-            logger.exception(f"Got exception while requesting {handle.handle}")
-            raise
+                self.raven_client.captureException(
+                    exc_info=(type(result), result, result.__traceback__)
+                )
+            logger.error(
+                f"Got exception while requesting {handle.handle}", exc_info=result
+            )
+            return None
+        else:
+            srs, images = result
         handle.error_count = 0
         handle.update_sr(srs)
-        await self._handle_new_sr(session, handle, srs, images)
+        return srs, images
+
+    async def _sync_handle(self, session, handle, force=False):
+        try:
+            result = await get_sr(handle, force=force)
+        except Exception as e:
+            result = e
+        new_sr = await run_sync(self._apply_sync_result, handle, result)
+        self.sync_scheduler.schedule(handle.id, handle.next_sync_at)
+        if isinstance(result, Exception) and not isinstance(
+            result, (ProfileUnchanged, UnableToFindSR)
+        ):
+            raise result
+        if new_sr:
+            await self._handle_new_sr(session, handle, *new_sr)
 
     async def _handle_new_sr(self, session, handle, srs, images):
         try:
@@ -3035,118 +3155,174 @@ Retail Jedi"""
 
             # we can still do the rest, no need to return here
 
-        for role_ix, rank, sr, type_to_check, image in zip(
-            range(3), handle.rank, srs, [SR.tank, SR.damage, SR.support], images
-        ):
+        if all(rank is None for rank in handle.rank):
+            return
 
-            if rank is not None:
-                # get highest SR, but exclude current_sr
-                await run_sync(session.commit)
-                prev_highest_sr_value = (
-                    session.query(func.max(type_to_check))
-                    .join(SR.handle)
-                    .filter(
-                        SR.id != handle.current_sr_id,
-                        Handle.user_id == handle.user_id,
-                        Handle.type == handle.type,
-                    )
-                )
+        prev_highest_srs = await self.database.previous_highest_srs(session, handle)
+        logger.debug(f"prev_srs {prev_highest_srs} {handle.rank}")
 
-                prev_highest_sr = (
-                    session.query(SR)
-                    .join(SR.handle)
-                    .filter(
-                        type_to_check == prev_highest_sr_value,
-                        Handle.user_id == handle.user_id,
-                        Handle.type == handle.type,
-                    )
-                    .order_by(desc(SR.timestamp))
-                    .first()
+        for role_ix, rank, sr, prev_highest_sr, image in zip(
+            range(3), handle.rank, srs, prev_highest_srs, images
+        ):
+            if (
+                rank is not None
+                and prev_highest_sr is not None
+                and rank > sr_to_rank(prev_highest_sr)
+            ):
+                logger.debug(
+                    f"handle {handle} role {role_ix} old SR {prev_highest_sr}, new rank {rank}, sending congrats…"
                 )
+                await self._send_congrats(handle, role_ix, sr, rank, image)
+
+    async def _sync_batch(self, handle_ids):
+        # handles coming from the sync scheduler have been removed from it, so they
+        # have to be rescheduled no matter what goes wrong
+        to_reschedule = handle_ids
+        # next_sync_at of the handles, only known once the batch has been committed
+        next_syncs = {}
+        try:
+            async with self.database.session() as session:
+                # we commit once and then still need the handles for nick updates and congrats
+                session.expire_on_commit = False
 
-                logger.debug(f"prev_sr {role_ix} {prev_highest_sr} {rank}")
-                if prev_highest_sr and rank > sr_to_rank(
-                    prev_highest_sr.values[role_ix]
-                ):
-                    logger.debug(
-                        f"handle {handle} role {role_ix} old SR {prev_highest_sr}, new rank {rank}, sending congrats…"
+                handles = await self.database.handles_by_ids(session, handle_ids)
+                to_reschedule = [handle.id for handle in handles]
+                if len(handles) != len(handle_ids):
+                    logger.warn(
+                        "%d handles not found, probably deleted",
+                        len(handle_ids) - len(handles),
                     )
-                    await self._send_congrats(handle, role_ix, sr, rank, image)
 
-    async def _sync_handles_from_channel(self, channel):
-        first = True
-        async with channel:
-            async for handle_id in channel:
-                if handle_id in self.sync_cache:
-                    logger.debug("Already updated, not doing it again")
-                    continue
-                else:
-                    self.sync_cache[handle_id] = True  # any value really
-                if not first:
-                    delay = 5 + random.random() * 10
-                    logger.debug(f"rate limiting: sleeping for {delay:3.02}s")
-                    await trio.sleep(delay)
-                else:
-                    first = False
-                async with self.database.session() as session:
+                results = {}
+
+                async def fetch(handle):
                     try:
-                        handle = await self.database.handle_by_id(session, handle_id)
-                        if handle:
-                            await self._sync_handle(session, handle)
-                        else:
-                            logger.warn(
-                                f"No handle for id {handle_id} found, probably deleted"
-                            )
-                        await run_sync(session.commit)
-                    except Exception:
-                        if handle:
+                        results[handle.id] = await get_sr(handle)
+                    except Exception as e:
+                        results[handle.id] = e
+
+                # rate limiting is done by FETCH_SCHEDULER
+                async with trio.open_nursery() as nursery:
+                    for handle in handles:
+                        nursery.start_soon(fetch, handle)
+
+                def apply_results():
+                    new_srs = []
+                    for handle in handles:
+                        try:
+                            # a broken handle must not take the whole batch with it
+                            with session.begin_nested():
+                                new_sr = self._apply_sync_result(
+                                    handle, results[handle.id]
+                                )
+                        except Exception:
                             logger.warn(
                                 f"exception while syncing {handle} for {handle.user.discord_id}",
                                 exc_info=True,
                             )
                         else:
-                            logger.warn(
-                                "Exception while getting handle for sync", exc_info=True
-                            )
-                    finally:
-                        try:
-                            await run_sync(session.commit)
-                        except Exception:
-                            logger.exception("cannot sync session")
+                            if new_sr:
+                                new_srs.append((handle, *new_sr))
+                    session.commit()
+                    next_syncs.update(
+                        (handle.id, handle.next_sync_at) for handle in handles
+                    )
+                    return new_srs
 
-    async def _sync_check(self):
-        async with self.database.session() as session:
-            ids_to_sync = await self.database.get_handles_to_be_synced(session)
-        if ids_to_sync:
-            logger.info(f"{len(ids_to_sync)} handles need to be synced")
-            await self._sync_handles(ids_to_sync)
-        else:
-            logger.debug("No tags need to be synced")
+                new_srs = await run_sync(apply_results)
+
+                for handle, srs, images in new_srs:
+                    try:
+                        await self._handle_new_sr(session, handle, srs, images)
+                    except Exception:
+                        logger.warn(
+                            f"exception while processing new SR of {handle}",
+                            exc_info=True,
+                        )
+                try:
+                    await run_sync(session.commit)
+                except Exception:
+                    logger.exception("cannot sync session")
+        finally:
+            now = datetime.utcnow()
+            retry_at = now + timedelta(minutes=5)
+            for handle_id in to_reschedule:
+                next_sync_at = next_syncs.get(handle_id)
+                self.sync_scheduler.schedule(
+                    handle_id,
+                    next_sync_at if next_sync_at and next_sync_at > now else retry_at,
+                )
+
+    async def _sync_batches_from_channel(self, channel):
+        async with channel:
+            async for handle_ids in channel:
+                try:
+                    await self._sync_batch(handle_ids)
+                except Exception:
+                    logger.exception("Exception while syncing batch")
 
     async def _sync_handles(self, ids_to_sync):
-        send_ch, receive_ch = trio.open_memory_channel(len(ids_to_sync))
+        # no deduplication needed, the sync scheduler has at most one entry per handle
+        batches = [
+            ids_to_sync[i : i + SYNC_BATCH_SIZE]
+            for i in range(0, len(ids_to_sync), SYNC_BATCH_SIZE)
+        ]
+        send_ch, receive_ch = trio.open_memory_channel(len(batches))
 
         async with send_ch:
-            for tag_id in ids_to_sync:
-                await send_ch.send(tag_id)
+            for batch in batches:
+                await send_ch.send(batch)
 
+        start = trio.current_time()
         async with trio.open_nursery() as nursery:
             async with receive_ch:
-                for _ in range(min(len(ids_to_sync), 5)):
+                # while one batch is being written to the database, the next one is already fetched
+                for _ in range(min(len(batches), SYNC_BATCH_WORKERS)):
                     nursery.start_soon(
-                        self._sync_handles_from_channel, receive_ch.clone()
+                        self._sync_batches_from_channel, receive_ch.clone()
                     )
-        logger.info("done syncing")
+        duration = trio.current_time() - start
+
+        resolutions = WEB_PROFILE_UUID_CACHE.take_pending()
+        if resolutions:
+            try:
+                async with self.database.session() as session:
+                    await self.database.save_web_profile_resolutions(
+                        session, resolutions
+                    )
+            except Exception:
+                logger.exception("unable to save web profile resolutions")
+                WEB_PROFILE_UUID_CACHE.return_pending(resolutions)
+
+        logger.info(
+            "done syncing %d handles in %.1fs (%.2f handles/s), %s, %s",
+            len(ids_to_sync),
+            duration,
+            len(ids_to_sync) / duration if duration else 0,
+            FETCH_SCHEDULER.stats(),
+            PROFILE_CACHE_STATS,
+        )
 
     async def _sync_all_handles_task(self):
         logger.debug("started waiting…")
         await trio.sleep(10)
+
+        async with self.database.session() as session:
+            for handle_id, next_sync_at in await self.database.get_sync_schedule(
+                session
+            ):
+                self.sync_scheduler.schedule(handle_id, next_sync_at)
+        logger.info("%d handles scheduled for syncing", len(self.sync_scheduler))
+
         while True:
             try:
-                await self._sync_check()
+                ids_to_sync = await self.sync_scheduler.wait_due(
+                    SYNC_BATCH_SIZE * SYNC_BATCH_WORKERS
+                )
+                logger.info(f"{len(ids_to_sync)} handles need to be synced")
+                await self._sync_handles(ids_to_sync)
             except Exception as e:
-                logger.exception(f"something went wrong during _sync_check")
-            await trio.sleep(5 * 60)
+                logger.exception(f"something went wrong during syncing")
 
     async def _cron_task(self):
         "poor man's cron"
@@ -3155,12 +3331,7 @@ Retail Jedi"""
             try:
                 logger.debug("checking Cron…")
                 async with self.database.session() as s:
-                    to_process = await run_sync(
-                        s.query(SR)
-                        .filter(SR.processed == False)
-                        .order_by(SR.timestamp.desc())
-                        .all
-                    )
+                    to_process = await self.database.unprocessed_srs(s)
 
                     logger.debug("to_process %s", to_process)
 
@@ -3189,14 +3360,12 @@ Retail Jedi"""
                         else:
                             logger.debug("already processed handle for %s", sr)
                         sr.processed = True
-                    s.commit()
+                    await run_sync(s.commit)
 
                 async with self.database.session() as s:
 
                     now = datetime.utcnow()
-                    to_run = await run_sync(
-                        s.query(HighscoreCron).filter(HighscoreCron.next_run <= now).limit(10).all
-                    )
+                    to_run = await self.database.due_highscore_crons(s, now)
 
                     logger.debug("to_run %s", to_run)
 
@@ -3300,12 +3469,9 @@ Retail Jedi"""
                 handles_to_check = handles
 
                 extra_text = ""
-                for guild in self._configured_guilds():
-                    if user_id in guild.members:
-                        extra_text = (
-                            self.guild_config[guild.id].extra_register_text or ""
-                        )
-                        break
+                for guild in self._configured_guilds_of(user_id):
+                    extra_text = self.guild_config[guild.id].extra_register_text or ""
+                    break
                 first, *others = handles
                 if others:
                     # Translators: type will be BattleTag or GamerTag, and it must be transformed into plural
@@ -3366,6 +3532,9 @@ Retail Jedi"""
                         )
                         existing_handle.handle = new_handle.handle
                         existing_handle.web_profile_uuid = None
+                        existing_handle.profile_etag = None
+                        existing_handle.profile_last_modified = None
+                        existing_handle.profile_hash = None
                         handles_to_check.append(existing_handle)
                         logger.debug(
                             f"handle name changed. handles_to_check is now {handles_to_check}"
@@ -3422,7 +3591,7 @@ Retail Jedi"""
                         )
                     )
                     async with user_channel.typing:
-                        srs, images = await get_sr(handle)
+                        srs, images = await get_sr(handle, force=True)
                 except InvalidBattleTag as e:
                     logger.exception(f"Got invalid {handle.desc} for {handle.handle}")
                     await user_channel.messages.send(
@@ -3458,11 +3627,21 @@ Retail Jedi"""
                     except Exception:
                         logger.exception("Unable to delete check message")
 
-                handle.update_sr(srs)
+                await run_sync(handle.update_sr, srs)
 
             sort_secondaries(user)
 
-            await run_sync(session.commit)
+            def commit():
+                session.flush()
+                # read before committing, afterwards they would need to be refreshed
+                next_syncs = [
+                    (handle.id, handle.next_sync_at) for handle in handles_to_check
+                ]
+                session.commit()
+                return next_syncs
+
+            for handle_id, next_sync_at in await run_sync(commit):
+                self.sync_scheduler.schedule(handle_id, next_sync_at)
 
             try:
                 await self._update_nick(user, force=True, raise_hierachy_error=True)
@@ -3526,6 +3705,15 @@ Retail Jedi"""
             if guild.id in self.guild_config
         ]
 
+    def _configured_guilds_of(self, member_id):
+        "Configured guilds the member is in"
+        guilds = []
+        for guild_id in sorted(self._member_index.guild_ids_of(member_id)):
+            guild = self.client.guilds.get(guild_id)
+            if guild and guild_id in self.guild_config and member_id in guild.members:
+                guilds.append(guild)
+        return guilds
+
 
 def fuzzy_nick_match(ann, ctx: Context, name: str):
     def strip_tags(name):
@@ -3600,7 +3788,6 @@ def fuzzy_nick_match(ann, ctx: Context, name: str):
 Context.add_converter(Member, fuzzy_nick_match)
 
 multio.init("trio")
-register_matplotlib_converters()
 
 GLaDOS: ContextVar[bool] = ContextVar("GLaDOS", default=False)
 
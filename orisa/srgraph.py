@@ -0,0 +1,104 @@
+# Orisa, a simple Discord bot with good intentions
+# Copyright (C) 2018, 2019 Dennis Brakhane
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, version 3 only
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from io import BytesIO
+
+import cachetools
+import matplotlib
+
+matplotlib.use("Agg")  # noqa
+
+import matplotlib.dates
+import matplotlib.ticker
+import numpy as np
+import seaborn as sns
+import trio
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+# only sets the default rcParams, which are read but never changed afterwards,
+# so figures can be drawn in several threads at once
+sns.set_theme(font="Lato")
+
+# line styles of tank, damage and support, like seaborn's default dashes
+LINE_STYLES = ("-", (0, (4, 1.5)), (0, (1, 1)))
+
+
+def _draw(fig, timestamps, columns, labels):
+    ax = fig.add_subplot()
+    ax.xaxis_date()
+
+    dates = np.array(matplotlib.dates.date2num(timestamps), dtype=float)
+    for values, label, style in zip(columns, labels, LINE_STYLES):
+        present = ~np.isnan(values)
+        if present.any():
+            ax.step(
+                dates[present], values[present], where="post", label=label, ls=style
+            )
+    ax.legend()
+
+    ax.xaxis.set_major_formatter(matplotlib.dates.DateFormatter("%Y-%m-%d"))
+    ax.yaxis.set_major_locator(
+        matplotlib.ticker.MaxNLocator(
+            nbins="auto", steps=[1, 1.25, 2.5, 5], integer=True
+        )
+    )
+    fig.autofmt_xdate()
+
+    ax.set_xlabel("Date")
+    ax.set_ylabel("SR")
+
+    image = BytesIO()
+    fig.savefig(image, format="png", transparent=False)
+    return image.getvalue()
+
+
+class SRGraphRenderer:
+    """Renders SR history graphs as PNG in worker threads.
+
+    Every worker draws on its own Agg figure, which is reused for the next
+    graph instead of going through pyplot. Rendered graphs are cached by key,
+    which has to change whenever the graph would (e.g. contain the id, timestamp
+    and values of the newest SR, which can be updated in place)."""
+
+    def __init__(self, workers=2, cache_size=256):
+        self._limiter = trio.CapacityLimiter(workers)
+        self._figures = []
+        self._cache = cachetools.LRUCache(maxsize=cache_size)
+
+    def cached(self, key):
+        "The PNG rendered for key, or None"
+        return self._cache.get(key)
+
+    async def render(self, key, timestamps, columns, labels):
+        """Renders the columns (tank, damage, support) of the SR history as step
+        plot, labeled with labels, and returns the PNG."""
+        columns = [np.array(column, dtype=float) for column in columns]
+
+        async with self._limiter:
+            # there are never more figures in use than the limiter allows
+            fig = self._figures.pop() if self._figures else None
+            if fig is None:
+                fig = Figure()
+                FigureCanvasAgg(fig)
+            try:
+                png = await trio.to_thread.run_sync(
+                    _draw, fig, timestamps, columns, labels
+                )
+            finally:
+                fig.clear()
+                self._figures.append(fig)
+
+        self._cache[key] = png
+        return png
@@ -0,0 +1,55 @@
+# Orisa, a simple Discord bot with good intentions
+# Copyright (C) 2018, 2019 Dennis Brakhane
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, version 3 only
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import numpy as np
+
+
+def _group_sums(values, groups, n_groups):
+    "Column wise sums of values per group, shape (n_groups, columns)"
+    n_cols = values.shape[1]
+    index = groups[:, np.newaxis] * n_cols + np.arange(n_cols)
+    return np.bincount(
+        index.ravel(), weights=values.ravel(), minlength=n_groups * n_cols
+    ).reshape(n_groups, n_cols)
+
+
+def trimmed_means(values, groups, n_groups, max_deviation=750):
+    """Per group and column mean of values, ignoring outliers.
+
+    values is a (rows, columns) matrix that may contain NaN for missing
+    values, groups the group index (0 to n_groups - 1) of every row. Values
+    that deviate more than max_deviation from the mean of their group and
+    column are left out of the final mean.
+
+    Returns (means, counts), both of shape (n_groups, columns). counts is the
+    number of non-NaN values, means is NaN where counts is 0 or every value
+    was an outlier."""
+
+    values = np.asarray(values, dtype=float)
+    groups = np.asarray(groups, dtype=np.intp)
+
+    present = ~np.isnan(values)
+    zeroed = np.where(present, values, 0)
+
+    counts = _group_sums(present.astype(float), groups, n_groups)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means = _group_sums(zeroed, groups, n_groups) / counts
+
+        keep = present & (np.abs(values - means[groups]) <= max_deviation)
+        trimmed = _group_sums(np.where(keep, values, 0), groups, n_groups) / (
+            _group_sums(keep.astype(float), groups, n_groups)
+        )
+
+    return trimmed, counts.astype(int)
@@ -13,6 +13,8 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 import atexit
+import hashlib
+import heapq
 import logging
 import logging.config
 import logging.handlers
@@ -21,7 +23,8 @@ import re
 import urllib.parse
 
 from bisect import bisect
-from collections import namedtuple
+from collections import defaultdict, deque, namedtuple
+from datetime import datetime, timedelta
 from operator import attrgetter
 from typing import TYPE_CHECKING, Optional
 
@@ -29,7 +32,7 @@ import asks
 import trio
 from cachetools.func import TTLCache
 from fuzzywuzzy import process
-from lxml import html
+from lxml import etree
 
 from curious.exc import ErrorCode, HTTPException
 
@@ -39,6 +42,7 @@ from .exceptions import (
     InvalidBattleTag,
     InvalidFormat,
     NicknameTooLong,
+    ProfileUnchanged,
     UnableToFindSR,
 )
 
@@ -48,6 +52,11 @@ if TYPE_CHECKING:
 
 logger = logging.getLogger(__name__)
 
+# connection pool of the database engine; there's no point in running more
+# DB threads than there are connections, they would just wait for one
+DB_POOL_SIZE = 20
+DB_MAX_OVERFLOW = 10
+
 if DATABASE_URI.startswith("sqlite://"):
     logger.warn(
         """\
@@ -64,7 +73,12 @@ if DATABASE_URI.startswith("sqlite://"):
 
 
 else:
-    from trio.to_thread import run_sync
+    # DB calls get their own limiter, so they neither compete with other threads
+    # for trio's default limiter nor get capped below the size of the connection pool
+    _DB_LIMITER = trio.CapacityLimiter(DB_POOL_SIZE + DB_MAX_OVERFLOW)
+
+    async def run_sync(method, *args):
+        return await trio.to_thread.run_sync(method, *args, limiter=_DB_LIMITER)
 
 
 class TDS(namedtuple("TDS", "tank damage support")):
@@ -80,29 +94,425 @@ SR_LOCKS = TTLCache(
 
 _SESSION = asks.Session(
     headers={"User-Agent": "Orisa/1.1 (+https://github.com/brakhane/Orisa)"},
-    connections=10,
+    connections=20,
+)
+
+
+class TokenBucket:
+    "A token bucket that hands out tokens in FIFO order"
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._last_refill = None
+        # trio.Lock is fair, so waiters are served in order
+        self._lock = trio.Lock()
+
+    def _refill(self):
+        now = trio.current_time()
+        if self._last_refill is not None:
+            self._tokens = min(
+                self.capacity, self._tokens + (now - self._last_refill) * self.rate
+            )
+        self._last_refill = now
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await trio.sleep((1 - self._tokens) / self.rate)
+
+
+FetchStats = namedtuple(
+    "FetchStats", "concurrency rate requests_per_second latency error_rate"
 )
 
-async def get_web_profile_uuid(btag: str) -> Optional[str]:    
+
+class FetchScheduler:
+    """Schedules all requests to Blizzard's site.
+
+    Every request needs a token from one global token bucket and a slot of a
+    capacity limiter. As long as Blizzard answers quickly and without errors,
+    the request rate and concurrency are increased additively; a 429, a 5xx, a timeout
+    or a latency above target_latency halves both (AIMD, like TCP)."""
+
+    def __init__(
+        self,
+        session,
+        *,
+        initial_rate=0.5,
+        min_rate=0.1,
+        max_rate=5.0,
+        rate_step=0.1,
+        min_concurrency=1,
+        max_concurrency=20,
+        target_latency=5.0,
+        window=60,
+    ):
+        self._session = session
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.rate_step = rate_step
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.target_latency = target_latency
+        self.window = window
+
+        # no bursts: requests are spaced by the rate even after an idle phase,
+        # only AIMD raises it
+        self.bucket = TokenBucket(rate=initial_rate, capacity=1)
+        self.limiter = trio.CapacityLimiter(min_concurrency)
+
+        self._latency = None
+        self._good_in_row = 0
+        self._last_decrease = float("-inf")
+        self._finished = deque()
+        self._failed = deque()
+
+    @property
+    def concurrency(self):
+        return self.limiter.total_tokens
+
+    async def get(self, url, **kwargs):
+        async with self.limiter:
+            await self.bucket.acquire()
+            start = trio.current_time()
+            try:
+                resp = await self._session.get(url, **kwargs)
+            except Exception:
+                self._record(start, ok=False)
+                raise
+            self._record(
+                start, ok=resp.status_code != 429 and resp.status_code < 500
+            )
+            return resp
+
+    def _record(self, start, *, ok):
+        now = trio.current_time()
+        latency = now - start
+        if self._latency is None:
+            self._latency = latency
+        else:
+            self._latency = 0.8 * self._latency + 0.2 * latency
+
+        self._finished.append(now)
+        if not ok:
+            self._failed.append(now)
+        self._expire(now)
+
+        if not ok or self._latency > self.target_latency:
+            self._good_in_row = 0
+            # one burst of errors should only count once
+            if now - self._last_decrease > self.target_latency:
+                self._last_decrease = now
+                self._adjust(self.concurrency // 2, self.bucket.rate / 2)
+        else:
+            self._good_in_row += 1
+            # increase roughly once per round of requests
+            if self._good_in_row >= self.concurrency:
+                self._good_in_row = 0
+                self._adjust(self.concurrency + 1, self.bucket.rate + self.rate_step)
+
+    def _adjust(self, concurrency, rate):
+        concurrency = max(self.min_concurrency, min(self.max_concurrency, concurrency))
+        rate = max(self.min_rate, min(self.max_rate, rate))
+        if concurrency != self.concurrency or rate != self.bucket.rate:
+            logger.debug(
+                "adjusting Blizzard fetch concurrency to %d, rate to %.2f/s",
+                concurrency,
+                rate,
+            )
+        self.limiter.total_tokens = concurrency
+        self.bucket.rate = rate
+
+    def _expire(self, now):
+        for timestamps in (self._finished, self._failed):
+            while timestamps and timestamps[0] < now - self.window:
+                timestamps.popleft()
+
+    def stats(self):
+        self._expire(trio.current_time())
+        return FetchStats(
+            concurrency=self.concurrency,
+            rate=self.bucket.rate,
+            requests_per_second=len(self._finished) / self.window,
+            latency=self._latency,
+            error_rate=len(self._failed) / len(self._finished)
+            if self._finished
+            else 0.0,
+        )
+
+
+FETCH_SCHEDULER = FetchScheduler(_SESSION)
+
+
+class ProfileCacheStats:
+    "Counts how often a career profile turned out to be unchanged"
+
+    def __init__(self):
+        self.not_modified = 0
+        self.unchanged = 0
+        self.changed = 0
+
+    @property
+    def hits(self):
+        return self.not_modified + self.unchanged
+
+    @property
+    def hit_ratio(self):
+        total = self.hits + self.changed
+        return self.hits / total if total else 0.0
+
+    def __str__(self):
+        return (
+            f"profile cache: {self.hit_ratio:.1%} hits ({self.not_modified} not modified, "
+            f"{self.unchanged} unchanged, {self.changed} changed)"
+        )
+
+
+PROFILE_CACHE_STATS = ProfileCacheStats()
+
+
+class WebProfileUUIDCache:
+    """In memory copy of the web_profile_resolutions table.
+
+    Lookups raise KeyError if the BattleTag is unknown or the entry expired;
+    a value of None means that Blizzard doesn't know the BattleTag. New entries
+    are collected until Orisa writes them to the database."""
+
+    def __init__(self, positive_ttl=timedelta(days=30), negative_ttl=timedelta(days=1)):
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self._entries = {}
+        self._pending = {}
+
+    def load(self, resolutions):
+        for battle_tag, uuid, resolved_at in resolutions:
+            self._entries[battle_tag] = (uuid, resolved_at)
+
+    def __getitem__(self, battle_tag):
+        uuid, resolved_at = self._entries[battle_tag]
+        ttl = self.positive_ttl if uuid else self.negative_ttl
+        if resolved_at < datetime.utcnow() - ttl:
+            raise KeyError(battle_tag)
+        return uuid
+
+    def __setitem__(self, battle_tag, uuid):
+        self._entries[battle_tag] = self._pending[battle_tag] = (
+            uuid,
+            datetime.utcnow(),
+        )
+
+    def __len__(self):
+        return len(self._entries)
+
+    def take_pending(self):
+        pending, self._pending = self._pending, {}
+        return pending
+
+    def return_pending(self, pending):
+        "Gives back entries from take_pending that couldn't be saved"
+        for battle_tag, entry in pending.items():
+            # entries resolved in the meantime are newer
+            self._pending.setdefault(battle_tag, entry)
+
+
+WEB_PROFILE_UUID_CACHE = WebProfileUUIDCache()
+
+
+async def get_web_profile_uuid(
+    btag: str, use_negative_cache: bool = True
+) -> Optional[str]:
     # return "c251a785fe23c8ffba|4ed031481f8ec8b79a9ed70f6ff8f08c"
+    try:
+        uuid = WEB_PROFILE_UUID_CACHE[btag]
+    except KeyError:
+        pass
+    else:
+        if uuid or use_negative_cache:
+            logger.debug("Got UUID %s for %s from cache", uuid, btag)
+            return uuid
+
     name, num = btag.split("#")
     try:
         logger.debug(f"Searching for UUID of {name}")
-        resp = await _SESSION.get(f"https://overwatch.blizzard.com/en-us/search/account-by-name/{urllib.parse.quote(name)}/")
+        resp = await FETCH_SCHEDULER.get(f"https://overwatch.blizzard.com/en-us/search/account-by-name/{urllib.parse.quote(name)}/")
         logger.debug(f"result is {resp}")
         entries = resp.json()
         logger.debug("Got results %s", entries)
+        uuid = None
         for entry in entries:
             if entry["battleTag"] == btag:
-                return entry["url"]
-        return None
+                uuid = entry["url"]
+                break
+        WEB_PROFILE_UUID_CACHE[btag] = uuid
+        return uuid
     except asks.errors.RequestTimeout:
         raise BlizzardError("Timeout")
     except Exception as e:
         raise BlizzardError("Something went wrong", e)
 
 
-async def get_sr(handle: "Handle"):
+class _RankSummaryTarget:
+    """lxml parser target that collects the role, rank and tier images of the
+    player summary.
+
+    Like the XPath expressions used before, this makes no assumption about how
+    the role and the rank images are nested: the images of every role div are
+    the roles, the first Profile-playerSummary--rank image of an element is a
+    rank, the second one a tier division, and the three lists are zipped.
+
+    Unlike those, only the first summary block is used: a role that was already
+    seen starts the block of another platform (e.g. controller), whose ranks
+    would otherwise overwrite the ones of the first block.
+
+    Parsing starts looking for the end of the summary at the parent of the first
+    Profile-playerSummary--* element. Whenever that element closes having
+    contributed roles, its parent might contain even more and is watched next;
+    once an element closes without adding any, or a role repeats, the summary is
+    complete and the rest of the career page is irrelevant."""
+
+    def __init__(self):
+        self.done = False
+        self._roles = []
+        self._ranks = []
+        self._tiers = []
+        # per open element: (is a role div, number of rank images seen in it)
+        self._stack = []
+        self._summary_depth = None
+        self._scope_depth = None
+        self._scope_roles = 0
+
+    def start(self, tag, attrib):
+        if self.done:
+            self._stack.append([False, 0])
+            return
+        classes = attrib.get("class", "").split()
+        depth = len(self._stack) + 1
+
+        if self._summary_depth is None and any(
+            cls.startswith("Profile-playerSummary--") for cls in classes
+        ):
+            self._summary_depth = depth
+            if self._scope_depth is None:
+                self._scope_depth = depth - 1
+
+        if tag == "img" and self._stack:
+            parent = self._stack[-1]
+            if parent[0]:
+                src = attrib.get("src")
+                if src in self._roles:
+                    # ranks of the next block that came before this role are
+                    # cut off by zip in close()
+                    self.done = True
+                    self._stack.append([False, 0])
+                    return
+                self._roles.append(src)
+            if "Profile-playerSummary--rank" in classes:
+                parent[1] += 1
+                if parent[1] == 1:
+                    self._ranks.append(attrib.get("src"))
+                elif parent[1] == 2:
+                    self._tiers.append(attrib.get("src"))
+
+        self._stack.append(
+            [tag == "div" and "Profile-playerSummary--role" in classes, 0]
+        )
+
+    def end(self, tag):
+        depth = len(self._stack)
+        self._stack.pop()
+        if self.done:
+            return
+        if depth == self._summary_depth:
+            self._summary_depth = None
+        elif depth == self._scope_depth:
+            if len(self._roles) > self._scope_roles:
+                self._scope_roles = len(self._roles)
+                self._scope_depth -= 1
+            elif self._roles:
+                self.done = True
+            else:
+                # the summary elements we saw didn't contain any roles, keep looking
+                self._scope_depth = None
+
+    def data(self, data):
+        pass
+
+    def close(self):
+        return list(zip(self._roles, self._ranks, self._tiers))
+
+
+async def parse_rank_summary(content: bytes, chunk_size: int = 16384):
+    """Returns a list of (role image, rank image, tier image) URLs from a career page.
+
+    The page is fed to the parser in chunks, and parsing stops as soon as
+    the rank summary is complete, so we neither build a DOM nor parse the
+    (much larger) rest of the page."""
+    target = _RankSummaryTarget()
+    parser = etree.HTMLParser(target=target)
+    for pos in range(0, len(content), chunk_size):
+        parser.feed(content[pos : pos + chunk_size])
+        if target.done:
+            break
+        await trio.sleep(0)
+    return parser.close()
+
+
+def extract_sr(rank_summary) -> tuple[TDS, TDS]:
+    srs = [None] * 3
+    imgs = [None] * 3
+
+    values = {
+        "Bronze": 1000,
+        "Silver": 1500,
+        "Gold": 2000,
+        "Platinum": 2500,
+        "Diamond": 3000,
+        "Master": 3500,
+        "Grandmaster": 4000,
+        "Ultimate": 4500,
+    }
+
+    for role, rank, tier in rank_summary:
+        if "tank" in role:
+            idx = 0
+        elif "offense" in role:
+            idx = 1
+        elif "support" in role:
+            idx = 2
+        elif "open" in role:
+            continue # FIXME
+        else:
+            raise ValueError(f"unknown role {role} in role image URL")
+
+        rm = re.search(r"/Rank_(\w+)Tier-", rank)
+        if not rm:
+            raise ValueError(f"cannot parse rank image {rank}")
+        tm = re.search(r"/TierDivision_(\d)", tier)
+        if not tm:
+            raise ValueError(f"cannot parse tier image {tier}")
+
+        rankname = rm.group(1)
+        division = int(tm.group(1))
+
+        srs[idx] = values[rankname] + (5 - division) * 100
+        imgs[idx] = rank
+
+        logger.debug(f"rank {rankname} div {division} idx {idx} sr {srs[idx]} {imgs[idx]}")
+
+    return (TDS(*srs), TDS(*imgs))
+
+
+async def get_sr(handle: "Handle", force: bool = False):
+    """Returns (srs, images) of the handle.
+
+    Raises ProfileUnchanged if the career profile didn't change since the last
+    call, unless force is set."""
     try:
         lock = SR_LOCKS[handle.handle]
     except KeyError:
@@ -123,7 +533,10 @@ async def get_sr(handle: "Handle"):
 
         if not handle.web_profile_uuid:
             logger.debug("No UUID for %s yet, searching", handle.handle)
-            uuid = await get_web_profile_uuid(handle.handle)
+            # a user who just created the account shouldn't have to wait a day
+            uuid = await get_web_profile_uuid(
+                handle.handle, use_negative_cache=not force
+            )
             if not uuid:
                 logger.debug("No UUID for %s found", handle.handle)
                 raise UnableToFindSR()
@@ -135,95 +548,50 @@ async def get_sr(handle: "Handle"):
             f'https://overwatch.blizzard.com/en-us/career/{handle.web_profile_uuid}/'
         )
 
+        headers = {}
+        if not force:
+            if handle.profile_etag:
+                headers["If-None-Match"] = handle.profile_etag
+            if handle.profile_last_modified:
+                headers["If-Modified-Since"] = handle.profile_last_modified
+
         logger.debug("requesting %s", url)
         try:
-            result = await _SESSION.get(url, connection_timeout=60, timeout=60)
+            result = await FETCH_SCHEDULER.get(
+                url, headers=headers, connection_timeout=60, timeout=60
+            )
         except asks.errors.RequestTimeout:
             raise BlizzardError("Timeout")
         except Exception as e:
             raise BlizzardError("Something went wrong", e)
 
+        if result.status_code == 304:
+            PROFILE_CACHE_STATS.not_modified += 1
+            raise ProfileUnchanged()
+
         if result.status_code != 200:
             if result.status_code == 404:
                 raise InvalidBattleTag(f"No profile for {handle.handle} found")
             else:
                 raise BlizzardError(f"got status code {result.status_code} from Blizz")
 
-        document = html.fromstring(result.content)
-        await trio.sleep(0)
-
-        def has_class(class_: str) -> str:
-            return f'contains(concat(" ", @class, " "), " {class_} ")'
-
-        def extract_sr(
-            role_imgs: list[html.HtmlElement], rank_imgs: list[html.HtmlElement], tier_imgs: list[html.HtmlElement]
-        ) -> tuple[TDS, TDS]:
-            srs = [None] * 3
-            imgs = [None] * 3
-
-            values = {
-                "Bronze": 1000,
-                "Silver": 1500,
-                "Gold": 2000,
-                "Platinum": 2500,
-                "Diamond": 3000,
-                "Master": 3500,
-                "Grandmaster": 4000,
-                "Ultimate": 4500,
-            }
+        rank_summary = await parse_rank_summary(result.content)
 
-            for role, rank, tier in zip(role_imgs, rank_imgs, tier_imgs):
-                if "tank" in role:
-                    idx = 0
-                elif "offense" in role:
-                    idx = 1
-                elif "support" in role:
-                    idx = 2
-                elif "open" in role:
-                    continue # FIXME
-                else:
-                    raise ValueError(f"unknown role {role} in role image URL")
-
-                rm = re.search(r"/Rank_(\w+)Tier-", rank)
-                if not rm:
-                    raise ValueError(f"cannot parse rank image {rank}")
-                tm = re.search(r"/TierDivision_(\d)", tier)
-                if not tm:
-                    raise ValueError(f"cannot parse tier image {tier}")
-
-                rankname = rm.group(1)
-                division = int(tm.group(1))
-
-                srs[idx] = values[rankname] + (5 - division) * 100
-                imgs[idx] = rank
-
-                logger.debug(f"rank {rankname} div {division} idx {idx} sr {srs[idx]} {imgs[idx]}")
-
-            return (TDS(*srs), TDS(*imgs))
-
-        rank_wrappers = document.xpath(
-            f'//div[{has_class("Profile-playerSummary--rankImageWrapper")}]'
-        )
+        # the rest of the page changes all the time, so only hash the part we are interested in
+        digest = hashlib.sha1(repr(rank_summary).encode()).hexdigest()
+        if not force and digest == handle.profile_hash:
+            PROFILE_CACHE_STATS.unchanged += 1
+            raise ProfileUnchanged()
 
-        srs_per_class = [
-            extract_sr(
-                role_imgs=rw.xpath(
-                    f'//div[{has_class("Profile-playerSummary--role")}]/img/@src'
-                ),
-                rank_imgs=rw.xpath(
-                    f'//img[{has_class("Profile-playerSummary--rank")}][1]/@src'
-                ),
-                tier_imgs=rw.xpath(
-                    f'//img[{has_class("Profile-playerSummary--rank")}][2]/@src'
-                )
-            )
-            for rw in rank_wrappers
-        ]
+        srs_img = extract_sr(rank_summary)
 
-        if not any(any(srs) for srs in srs_per_class):
-            raise UnableToFindSR()
+        # only remember the page once we know we can parse it
+        result_headers = {k.lower(): v for k, v in result.headers.items()}
+        handle.profile_etag = result_headers.get("etag")
+        handle.profile_last_modified = result_headers.get("last-modified")
+        handle.profile_hash = digest
+        PROFILE_CACHE_STATS.changed += 1
 
-        srs_img = srs_per_class[0]
         if not any(srs_img[0]):
             raise UnableToFindSR()
 
@@ -234,6 +602,230 @@ async def get_sr(handle: "Handle"):
         lock.release()
 
 
+class SyncScheduler:
+    """Knows when each handle is due to be synced next.
+
+    Rescheduling a handle just pushes a new heap entry, outdated entries are
+    skipped when they reach the top of the heap."""
+
+    def __init__(self):
+        self._heap = []
+        self._due = {}
+        self._changed = trio.Event()
+
+    def __len__(self):
+        return len(self._due)
+
+    def schedule(self, handle_id, when):
+        self._due[handle_id] = when
+        heapq.heappush(self._heap, (when, handle_id))
+        if self._heap[0] == (when, handle_id):
+            # the waiter might need to wake up earlier than planned
+            self._changed.set()
+
+    def _drop_outdated(self):
+        while self._heap and self._due.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+
+    async def wait_due(self, max_items):
+        "Waits until at least one handle is due and returns the ids of up to max_items due handles"
+        while True:
+            self._drop_outdated()
+            if self._heap:
+                now = datetime.utcnow()
+                delay = (self._heap[0][0] - now).total_seconds()
+                if delay <= 0:
+                    due = []
+                    while (
+                        self._heap and len(due) < max_items and self._heap[0][0] <= now
+                    ):
+                        when, handle_id = heapq.heappop(self._heap)
+                        if self._due.get(handle_id) == when:
+                            del self._due[handle_id]
+                            due.append(handle_id)
+                    if due:
+                        return due
+                    continue
+            else:
+                delay = float("inf")
+
+            self._changed = trio.Event()
+            with trio.move_on_after(delay):
+                await self._changed.wait()
+
+
+class NickRefreshProgress:
+    "Progress of a bulk nickname refresh"
+
+    def __init__(self):
+        self.checked = 0
+        self.to_change = 0
+        self.changed = 0
+        self.failed = 0
+        self.finished = False
+
+    def as_dict(self):
+        return {
+            "checked": self.checked,
+            "to_change": self.to_change,
+            "changed": self.changed,
+            "failed": self.failed,
+            "finished": self.finished,
+        }
+
+    def __str__(self):
+        return (
+            f"{self.checked} nicks checked, {self.changed}/{self.to_change} changed, "
+            f"{self.failed} failed{'' if self.finished else ' (still running)'}"
+        )
+
+
+class GuildMemberIndex:
+    """Reverse index of the guilds a member is in (discord id -> guild ids).
+
+    Guilds whose member list changed in bulk (new guild, member chunks) are
+    only marked and get (re)indexed on the next lookup."""
+
+    def __init__(self):
+        self._guild_ids = defaultdict(set)
+        self._stale_guilds = {}
+
+    def guild_changed(self, guild):
+        self._stale_guilds[guild.id] = guild
+
+    def remove_guild(self, guild):
+        self._stale_guilds.pop(guild.id, None)
+        for member_id in list(guild.members.keys()):
+            self.remove(member_id, guild.id)
+
+    def add(self, member_id, guild_id):
+        self._guild_ids[member_id].add(guild_id)
+
+    def remove(self, member_id, guild_id):
+        guild_ids = self._guild_ids.get(member_id)
+        if guild_ids is not None:
+            guild_ids.discard(guild_id)
+            if not guild_ids:
+                del self._guild_ids[member_id]
+
+    def guild_ids_of(self, member_id):
+        while self._stale_guilds:
+            guild_id, guild = self._stale_guilds.popitem()
+            for id in guild.members.keys():
+                self._guild_ids[id].add(guild_id)
+        return frozenset(self._guild_ids.get(member_id, ()))
+
+
+class ChannelRenameScheduler:
+    """Discord only allows 2 renames within 10 minutes per channel.
+
+    Renames are queued here and performed by a few workers in the order in which
+    the channels' rename budgets allow it. Only the newest requested name of a
+    channel is kept, so a channel is never renamed more often than necessary.
+
+    rename is an async callable (channel, name) that returns whether a rename
+    was actually sent to Discord (and therefore used up budget)."""
+
+    RENAMES_PER_INTERVAL = 2
+    # 10 minutes + 2 seconds safety margin
+    RESET_INTERVAL = 602
+
+    def __init__(self, rename, *, workers=4, max_pending=5000):
+        self._rename = rename
+        self._workers = workers
+        self._max_pending = max_pending
+        # channel id -> (channel, name)
+        self._pending = {}
+        # channel id -> (reset time, remaining renames); entries whose reset time
+        # has passed are equivalent to a full budget and get pruned
+        self._budgets = {}
+        self._prune_at = 1000
+        # (time the rename can be performed, channel id), one entry per pending
+        # channel that isn't currently being renamed
+        self._heap = []
+        self._in_flight = set()
+        self._changed = trio.Event()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def _ready_at(self, channel_id, now):
+        reset_time, remaining = self._budgets.get(
+            channel_id, (now, self.RENAMES_PER_INTERVAL)
+        )
+        return now if remaining or reset_time <= now else reset_time
+
+    def _push(self, channel_id):
+        now = trio.current_time()
+        heapq.heappush(self._heap, (self._ready_at(channel_id, now), channel_id))
+        if self._heap[0][1] == channel_id:
+            self._changed.set()
+
+    def _use_budget(self, channel_id, now):
+        reset_time, remaining = self._budgets.get(channel_id, (now, 0))
+        if reset_time <= now:
+            # first rename in a new interval
+            reset_time = now + self.RESET_INTERVAL
+            remaining = self.RENAMES_PER_INTERVAL
+        self._budgets[channel_id] = (reset_time, remaining - 1)
+
+        if len(self._budgets) >= self._prune_at:
+            self._budgets = {
+                id: budget for id, budget in self._budgets.items() if budget[0] > now
+            }
+            self._prune_at = max(1000, 2 * len(self._budgets))
+
+    def request(self, channel, name):
+        channel_id = channel.id
+        if channel_id not in self._pending:
+            if len(self._pending) >= self._max_pending:
+                logger.warning(
+                    "Too many pending channel renames, dropping rename of %s to %s",
+                    channel,
+                    name,
+                )
+                return
+            if channel_id not in self._in_flight:
+                self._push(channel_id)
+        self._pending[channel_id] = (channel, name)
+
+    async def _worker(self):
+        while True:
+            if not self._heap:
+                delay = float("inf")
+            else:
+                delay = self._heap[0][0] - trio.current_time()
+
+            if delay > 0:
+                # all idle workers share the event, the first one to notice it
+                # has fired replaces it
+                if self._changed.is_set():
+                    self._changed = trio.Event()
+                changed = self._changed
+                with trio.move_on_after(delay):
+                    await changed.wait()
+                continue
+
+            _, channel_id = heapq.heappop(self._heap)
+            channel, name = self._pending.pop(channel_id)
+            self._in_flight.add(channel_id)
+            try:
+                if await self._rename(channel, name):
+                    self._use_budget(channel_id, trio.current_time())
+            except Exception:
+                logger.exception("Unable to rename channel %s to %s", channel, name)
+            finally:
+                self._in_flight.discard(channel_id)
+                if channel_id in self._pending:
+                    # a new name was requested while we were busy
+                    self._push(channel_id)
+
+    async def run(self):
+        async with trio.open_nursery() as nursery:
+            for i in range(self._workers):
+                nursery.start_soon(self._worker)
+
+
 def sort_secondaries(user):
     user.handles[1:] = list(sorted(user.handles[1:], key=attrgetter("handle")))
     user.handles.reorder()
@@ -39,8 +39,8 @@ from .config import (
 )
 from .config_classes import GuildConfig
 from .i18n import _, ngettext, CurrentLocale
-from .models import User, GuildConfigJson, HighscoreCron
-from .utils import run_sync
+from .models import GuildConfigJson, HighscoreCron
+from .utils import NickRefreshProgress, run_sync
 
 logger = logging.getLogger(__name__)
 
@@ -253,9 +253,8 @@ def validate_config(guild, guild_config):
     return errors
 
 
-@app.route(OAUTH_REDIRECT_PATH + "guild_config/<int:guild_id>", methods=["PUT"])
-async def save(guild_id):
-
+def authorization_error():
+    "Checks the bearer token of the request, returns an error response if it's not valid"
     try:
         token = request.headers["authorization"].split(" ")[1]
     except (KeyError, IndexError):
@@ -268,6 +267,16 @@ async def save(guild_id):
     except BadSignature:
         return "Invalid token", 401, {"WWW-Authenticate": "Bearer"}
 
+    return None
+
+
+@app.route(OAUTH_REDIRECT_PATH + "guild_config/<int:guild_id>", methods=["PUT"])
+async def save(guild_id):
+
+    error = authorization_error()
+    if error:
+        return error
+
     new_gi = GuildConfig.from_json2(await request.data)
     logger.debug(f"old info: {orisa.guild_config[guild_id]}")
     logger.debug(f"new info: {new_gi}")
@@ -324,22 +333,32 @@ async def save(guild_id):
             except Exception:
                 logger.exception("Cannot initialize voice channels")
 
-        async with orisa.database.session() as session:
-            for user in await run_sync(
-                session.query(User)
-                .filter(User.discord_id.in_(guild.members.keys()))
-                .all
-            ):
-                try:
-                    await orisa._update_nick(user)
-                except Exception:
-                    logger.error("Exception during update", exc_info=True)
+        progress = orisa.nick_refreshes[guild_id] = NickRefreshProgress()
+        try:
+            await orisa._refresh_nicks([guild], progress)
+        except Exception:
+            logger.error("Exception during update", exc_info=True)
 
     await orisa.spawn(update)
 
     return "", 204
 
 
+@app.route(OAUTH_REDIRECT_PATH + "guild_config/<int:guild_id>/nick_refresh")
+async def nick_refresh_progress(guild_id):
+
+    error = authorization_error()
+    if error:
+        return error
+
+    try:
+        progress = orisa.nick_refreshes[guild_id]
+    except KeyError:
+        return "No nick refresh for this guild", 404
+
+    return jsonify(progress.as_dict())
+
+
 @app.route(OAUTH_REDIRECT_PATH)
 async def handle_oauth():
 
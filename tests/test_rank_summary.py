@@ -0,0 +1,137 @@
+from pathlib import Path
+
+import pytest
+import trio
+from lxml import html
+
+from orisa.utils import extract_sr, parse_rank_summary
+
+FIXTURE = Path(__file__).parent / "fixtures" / "career_summary.html"
+
+ROLE = "https://static.playoverwatch.com/img/pages/career/icons/role/{}.svg#icon"
+RANK = "https://static.playoverwatch.com/img/pages/career/icons/rank/Rank_{}Tier-3d4c5a6b7e.png"
+TIER = "https://static.playoverwatch.com/img/pages/career/icons/rank/TierDivision_{}-1a2b3c4d5e.png"
+
+
+def xpath_rank_summary(content):
+    "What the DOM based parser used to extract"
+    document = html.fromstring(content)
+
+    def has_class(class_):
+        return f'contains(concat(" ", @class, " "), " {class_} ")'
+
+    return list(
+        zip(
+            document.xpath(
+                f'//div[{has_class("Profile-playerSummary--role")}]/img/@src'
+            ),
+            document.xpath(
+                f'//img[{has_class("Profile-playerSummary--rank")}][1]/@src'
+            ),
+            document.xpath(
+                f'//img[{has_class("Profile-playerSummary--rank")}][2]/@src'
+            ),
+        )
+    )
+
+
+def parse(content, chunk_size=16384):
+    return trio.run(parse_rank_summary, content, chunk_size)
+
+
+def role_div(role):
+    return f'<div class="Profile-playerSummary--role"><img src="{ROLE.format(role)}"></div>'
+
+
+def rank_wrapper(rank, tier, inner=""):
+    return (
+        '<div class="Profile-playerSummary--rankImageWrapper">'
+        f'{inner}<img class="Profile-playerSummary--rank" src="{RANK.format(rank)}">'
+        f'<img class="Profile-playerSummary--rank" src="{TIER.format(tier)}"></div>'
+    )
+
+
+def page(summary):
+    return (
+        "<html><body><blz-section class='Profile-masthead'>"
+        f"<div class='Profile-player--summaryWrapper'>{summary}</div></blz-section>"
+        "<blz-section class='stats'><div class='stat-item'>42</div></blz-section>"
+        "</body></html>"
+    ).encode()
+
+
+ROLES = [("tank", "Gold", 3), ("offense", "Platinum", 1), ("support", "Diamond", 5)]
+CONTROLLER_ROLES = [("tank", "Bronze", 3), ("offense", "Silver", 2), ("support", "Gold", 1)]
+
+
+def layouts(roles):
+    return {
+        "role before rank wrapper": "".join(
+            f'<div class="Profile-playerSummary--roleWrapper">{role_div(role)}{rank_wrapper(rank, tier)}</div>'
+            for role, rank, tier in roles
+        ),
+        "role after rank wrapper": "".join(
+            f'<div class="Profile-playerSummary--roleWrapper">{rank_wrapper(rank, tier)}{role_div(role)}</div>'
+            for role, rank, tier in roles
+        ),
+        "role inside rank wrapper": "".join(
+            rank_wrapper(rank, tier, inner=role_div(role)) for role, rank, tier in roles
+        ),
+        "every role in its own container": "".join(
+            f'<div class="role-container"><div class="Profile-playerSummary--roleWrapper">'
+            f"{role_div(role)}{rank_wrapper(rank, tier)}</div></div>"
+            for role, rank, tier in roles
+        ),
+    }
+
+
+LAYOUTS = layouts(ROLES)
+CONTROLLER_LAYOUTS = layouts(CONTROLLER_ROLES)
+
+
+def test_fixture_matches_xpath():
+    content = FIXTURE.read_bytes()
+    summary = parse(content)
+
+    assert summary == xpath_rank_summary(content)
+    assert extract_sr(summary)[0] == (2200, 2900, 3000)
+
+
+@pytest.mark.parametrize("chunk_size", [64, 16384])
+def test_fixture_in_chunks(chunk_size):
+    content = FIXTURE.read_bytes()
+
+    assert parse(content, chunk_size) == xpath_rank_summary(content)
+
+
+@pytest.mark.parametrize("layout", LAYOUTS)
+def test_layouts_match_xpath(layout):
+    content = page(LAYOUTS[layout])
+    summary = parse(content)
+
+    assert summary == xpath_rank_summary(content)
+    assert extract_sr(summary)[0] == (2200, 2900, 3000)
+
+
+def test_no_summary():
+    assert parse(page("<p>This profile is private</p>")) == []
+
+
+@pytest.mark.parametrize("layout", LAYOUTS)
+def test_only_first_platform(layout):
+    pc = page(LAYOUTS[layout])
+    both = page(
+        f'<div class="Profile-playerSummary--rankWrapper mouseKeyboard-view">{LAYOUTS[layout]}</div>'
+        f'<div class="Profile-playerSummary--rankWrapper controller-view">{CONTROLLER_LAYOUTS[layout]}</div>'
+    )
+    summary = parse(both)
+
+    assert summary == xpath_rank_summary(pc)
+    assert extract_sr(summary)[0] == (2200, 2900, 3000)
+
+
+def test_only_first_platform_in_same_wrapper():
+    summary = parse(page(LAYOUTS["role before rank wrapper"] + CONTROLLER_LAYOUTS["role before rank wrapper"]))
+
+    assert len(summary) == 3
+    assert extract_sr(summary)[0] == (2200, 2900, 3000)
@@ -0,0 +1,92 @@
+import warnings
+
+import numpy as np
+import pytest
+
+from orisa.stats import trimmed_means
+
+
+def nanmean_per_group(values, groups, n_groups, max_deviation=750):
+    """The per channel code trimmed_means replaced.
+
+    Returns one entry per group: None for a group without rows, otherwise a
+    list with 0 for a column without values and NaN if every value was an outlier."""
+    result = []
+    for group in range(n_groups):
+        combined = values[groups == group]
+        if not len(combined):
+            result.append(None)
+            continue
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)
+            result.append(
+                [
+                    0
+                    if np.all(np.isnan(x))
+                    else np.nanmean(x[np.abs(x - np.nanmean(x)) <= max_deviation])
+                    for x in combined.T
+                ]
+            )
+    return result
+
+
+def random_srs(rng, n_rows, n_groups):
+    values = rng.integers(500, 4800, size=(n_rows, 3)).astype(float)
+    values[rng.random((n_rows, 3)) < 0.3] = np.nan
+    groups = rng.integers(0, n_groups, size=n_rows)
+    return values, groups
+
+
+def assert_equivalent(values, groups, n_groups):
+    means, counts = trimmed_means(values, groups, n_groups)
+    expected = nanmean_per_group(values, groups, n_groups)
+
+    for group, old in enumerate(expected):
+        if old is None:
+            assert (counts[group] == 0).all()
+            continue
+        for mean, count, old_mean in zip(means[group], counts[group], old):
+            if count == 0:
+                assert old_mean == 0
+            elif np.isnan(old_mean):
+                assert np.isnan(mean)
+            else:
+                assert mean == pytest.approx(old_mean)
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_random_data(seed):
+    rng = np.random.default_rng(seed)
+    n_groups = int(rng.integers(1, 12))
+    values, groups = random_srs(rng, int(rng.integers(0, 60)), n_groups)
+
+    assert_equivalent(values, groups, n_groups)
+
+
+def test_empty_groups():
+    values = np.array([[2000, np.nan, 2500], [2100, 3000, np.nan]])
+    groups = np.array([1, 1])
+
+    assert_equivalent(values, groups, 4)
+    means, counts = trimmed_means(values, groups, 4)
+    assert counts.tolist() == [[0, 0, 0], [2, 1, 1], [0, 0, 0], [0, 0, 0]]
+
+
+def test_all_outliers():
+    # both values are 1000 away from their mean
+    values = np.array([[1000, 2000, np.nan], [3000, 2100, np.nan], [2500, 2500, 2500]])
+    groups = np.array([0, 0, 1])
+
+    assert_equivalent(values, groups, 2)
+    means, counts = trimmed_means(values, groups, 2)
+    assert np.isnan(means[0, 0])
+    assert means[0, 1] == 2050
+    assert counts[0, 2] == 0
+    assert means[1].tolist() == [2500, 2500, 2500]
+
+
+def test_no_rows():
+    means, counts = trimmed_means(np.empty((0, 3)), np.empty(0, dtype=int), 3)
+
+    assert means.shape == counts.shape == (3, 3)
+    assert (counts == 0).all()
@@ -0,0 +1,108 @@
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+
+from orisa.models import Base, BattleTag, User
+from orisa.utils import TDS
+
+START = datetime(2020, 1, 1)
+
+
+@pytest.fixture
+def session():
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(engine)
+    # same settings as Database
+    session = sessionmaker(bind=engine, autoflush=False)()
+    yield session
+    session.close()
+
+
+@contextmanager
+def count_statements(session):
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    engine = session.get_bind()
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
+
+
+def make_handle(session, *srs, flush=True):
+    user = User(discord_id=1, format="$sr")
+    handle = BattleTag(battle_tag="Foo#1234")
+    user.handles.append(handle)
+    session.add(user)
+    if flush:
+        session.flush()
+    for days, sr in enumerate(srs):
+        handle.update_sr(TDS(*sr), timestamp=START + timedelta(days=days))
+        session.flush()
+    return handle
+
+
+def history(handle):
+    return [(sr.timestamp, sr.values) for sr in handle.sr_history]
+
+
+def test_first_sr_of_unflushed_handle(session):
+    handle = make_handle(session, flush=False)
+
+    with count_statements(session) as statements:
+        handle.update_sr(TDS(2500, None, None), timestamp=START)
+
+    assert statements == []
+    session.flush()
+    assert history(handle) == [(START, (2500, None, None))]
+    assert handle.current_sr.values == (2500, None, None)
+
+
+def test_first_sr(session):
+    handle = make_handle(session)
+
+    with count_statements(session) as statements:
+        handle.update_sr(TDS(2500, None, None), timestamp=START)
+
+    assert len(statements) == 1
+    session.flush()
+    assert history(handle) == [(START, (2500, None, None))]
+
+
+def test_new_sr(session):
+    handle = make_handle(session, (2500, 2600, 2700))
+    timestamp = START + timedelta(days=1)
+
+    with count_statements(session) as statements:
+        handle.update_sr(TDS(2550, 2600, 2700), timestamp=timestamp)
+
+    assert len(statements) == 1
+    session.flush()
+    assert history(handle) == [
+        (timestamp, (2550, 2600, 2700)),
+        (START, (2500, 2600, 2700)),
+    ]
+    assert handle.current_sr.values == (2550, 2600, 2700)
+
+
+def test_unchanged_sr_extends_last_row(session):
+    handle = make_handle(session, (2500, 2600, 2700), (2500, 2600, 2700))
+    timestamp = START + timedelta(days=2)
+
+    with count_statements(session) as statements:
+        handle.update_sr(TDS(2500, 2600, 2700), timestamp=timestamp)
+
+    assert len(statements) == 1
+    session.flush()
+    # the newest row is moved forward instead of adding a third one
+    assert history(handle) == [
+        (timestamp, (2500, 2600, 2700)),
+        (START, (2500, 2600, 2700)),
+    ]